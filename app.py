@@ -10,6 +10,7 @@ def create_app(config_update=None):
     app = Flask(__name__)
 
     SESSION_SECRET_KEY = "session_secret"
+    SIGNED_SESSION_KEY = "signed_session"
     SECRET_FILE_PATH = Path("../.flask_secret")
     try:
         # Read secret from the secret file
@@ -39,6 +40,10 @@ def create_app(config_update=None):
     if not config_ini["email"].get("FROM_EMAIL"):
         raise Exception("FROM_EMAIL not found in config.ini's email section'.")
 
+    from db.connection import parse_sqlite_pragmas
+
+    SQLITE_PRAGMAS = parse_sqlite_pragmas(config_ini["sqlite"]) if config_ini.has_section("sqlite") else {}
+
     app.config.update(
         # Flask config values
         SESSION_COOKIE_SAMESITE="Lax" if app.config["DEBUG"] else "None",
@@ -50,9 +55,58 @@ def create_app(config_update=None):
         APP_NAME="Your App",
         SERVER_NAME=SERVER_NAME,
         SESSION_SECRET_KEY=SESSION_SECRET_KEY,
+        SIGNED_SESSION_KEY=SIGNED_SESSION_KEY,
+        # Opt-in: number of seconds during which the user id, current account id and session id signed in the Flask
+        # session cookie are trusted without checking the session table. Logging out takes effect immediately in all
+        # the worker processes, through DATA_DIR/logouts.db (see db.logouts). 0 disables it.
+        SIGNED_SESSION_TTL=0,
         SENDGRID_API_KEY=config_ini["email"]["SENDGRID_API_KEY"],
         FROM_EMAIL=config_ini["email"]["FROM_EMAIL"],
+        # Emails are queued in the email_outbox table and delivered by a background thread (see blueprints.email)
+        # through EMAIL_TRANSPORT: "sendgrid", or "file" to write them to EMAIL_FILE_SINK_DIR (DATA_DIR/outbox if None).
+        # With EMAIL_WORKER False, they're only delivered by `python maintenance.py deliver-emails`.
+        # Failed deliveries are retried after EMAIL_RETRY_DELAY seconds, doubled after each of the EMAIL_MAX_ATTEMPTS.
+        EMAIL_TRANSPORT="sendgrid",
+        EMAIL_FILE_SINK_DIR=None,
+        EMAIL_WORKER=True,
+        EMAIL_CONCURRENCY=4,
+        EMAIL_MAX_ATTEMPTS=5,
+        EMAIL_RETRY_DELAY=30,
+        EMAIL_POLL_INTERVAL=10,
+        # Sent and given up emails are deleted after EMAIL_OUTBOX_RETENTION by `python maintenance.py purge-emails`
+        EMAIL_OUTBOX_RETENTION=timedelta(days=7),
         DATA_DIR=Path("data"),
+        SQLITE_PRAGMAS=SQLITE_PRAGMAS,
+        # In-process caches of users, accounts and sessions: max number of entries, and seconds before they
+        # expire. Since each worker process has its own cache, changes are seen by the other ones after CACHE_TTL.
+        # Logouts are seen at once: the sessions of the users logged out since are checked again (see db.logouts).
+        CACHE_SIZE=10000,
+        CACHE_TTL=60,
+        # Non-critical updates (last login time, current account) are written every WRITE_BEHIND_INTERVAL seconds, or
+        # as soon as WRITE_BEHIND_MAX_SIZE rows are pending, see db.write_behind. 0 writes them immediately.
+        WRITE_BEHIND_INTERVAL=1.0,
+        WRITE_BEHIND_MAX_SIZE=1000,
+        # Sessions expired for more than SESSION_REAPER_GRACE_PERIOD are deleted by `python maintenance.py reap-sessions`,
+        # or every SESSION_REAPER_INTERVAL seconds by a background thread if it's not 0
+        SESSION_REAPER_GRACE_PERIOD=timedelta(days=7),
+        SESSION_REAPER_BATCH_SIZE=500,
+        SESSION_REAPER_INTERVAL=0,
+        # Guest users without session created more than GUEST_GC_AGE ago are deleted by `python maintenance.py gc-guests`
+        GUEST_GC_AGE=timedelta(days=31),
+        # Passwords are hashed with PASSWORD_HASH_METHOD ("scrypt:N:r:p", or "scrypt" for werkzeug's defaults) by
+        # PASSWORD_HASH_WORKERS processes, see passwords.py. When PASSWORD_HASH_MAX_QUEUE hashes are already waiting,
+        # logins fail with 503. 0 workers hash in the request.
+        PASSWORD_HASH_METHOD="scrypt:32768:8:1",
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_MAX_QUEUE=32,
+        # Requests to login, signup, forgotten_password and reset_password are limited per client IP and per email, see
+        # ratelimit.py: (capacity, period) lets capacity requests through at once, refilled in period seconds (None for
+        # no limit). Buckets are kept in "memory" per process, or in RATE_LIMIT_DB_FILE ("sqlite") shared by the
+        # processes (DATA_DIR/rate_limits.db if None). A None backend disables the limits.
+        RATE_LIMIT_BACKEND="memory",
+        RATE_LIMIT_DB_FILE=None,
+        RATE_LIMIT_PER_IP=(30, 300),
+        RATE_LIMIT_PER_EMAIL=(10, 300),
     )
     if config_update:
         app.config.update(config_update)
@@ -61,13 +115,54 @@ def create_app(config_update=None):
     app.static_folder = "static"
 
     with app.app_context():
+        from blueprints.assets import assets
         from blueprints.auth import auth
         from blueprints.email import email
         from blueprints.main import main
+        from migrate import get_migrations
+
+        # Read the migration files once at startup, rather than during signups
+        get_migrations("auth")
+        get_migrations("accounts")
 
+    app.register_blueprint(assets)
     app.register_blueprint(auth)
     app.register_blueprint(email)
     app.register_blueprint(main)
+
+    # Close the database connections shared during the request
+    from db.connection import close_connections
+
+    app.teardown_appcontext(close_connections)
+
+    from db.write_behind import buffer
+
+    buffer.configure(app.config["WRITE_BEHIND_INTERVAL"], app.config["WRITE_BEHIND_MAX_SIZE"])
+
+    if app.config["EMAIL_WORKER"]:
+        from blueprints.email import outbox_worker
+
+        # Deliver the emails left due by the previous processes, and the retries, without waiting for a new email
+        outbox_worker.wake(app)
+
+    from passwords import hasher
+
+    hasher.configure(
+        app.config["PASSWORD_HASH_METHOD"], app.config["PASSWORD_HASH_WORKERS"], app.config["PASSWORD_HASH_MAX_QUEUE"]
+    )
+
+    from ratelimit import limiter
+
+    limiter.configure(
+        app.config["RATE_LIMIT_BACKEND"],
+        app.config["RATE_LIMIT_DB_FILE"] or app.config["DATA_DIR"] / "rate_limits.db",
+        {"ip": app.config["RATE_LIMIT_PER_IP"], "email": app.config["RATE_LIMIT_PER_EMAIL"]},
+    )
+
+    if app.config["SESSION_REAPER_INTERVAL"]:
+        from maintenance import start_session_reaper
+
+        start_session_reaper(app)
     return app
 
 
@@ -0,0 +1,365 @@
+"""Benchmarks of the app's hot paths. Run with: python benchmark.py"""
+import contextlib
+import io
+import re
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from unittest.mock import patch
+
+import app
+
+
+def measure_requests(client, method, path, repeat=20, **kwargs):
+    """Return (connections opened, SQL statements run, milliseconds) per request for the given request"""
+    from db import connection
+
+    statements = []
+
+    def connect_and_trace(db_file_name):
+        con = connect_to_db(db_file_name)
+        con.set_trace_callback(statements.append)
+        return con
+
+    connect_to_db = connection.connect_to_db
+    open_count = connection.MyConnect.open_count
+    with patch("db.connection.connect_to_db", connect_and_trace):
+        start_time = perf_counter()
+        for _ in range(repeat):
+            response = getattr(client, method)(path, **kwargs)
+            assert response.status_code < 400, response.status_code
+        elapsed = perf_counter() - start_time
+    return (connection.MyConnect.open_count - open_count) / repeat, len(statements) / repeat, elapsed * 1000 / repeat
+
+
+def bench_requests(flask_app):
+    from db import identity_map
+    from db.models.auth.user import User
+
+    line = "  {:28} {:6.1f} connections, {:6.1f} statements, {:8.3f} ms"
+    print("Per request:")
+    # A new client without cookie for each hit, like a crawler would do
+    print(line.format("cookieless GET /:", *measure_requests(flask_app.test_client(), "get", "/", repeat=1)))
+
+    client = flask_app.test_client()
+    client.post("/signup", data=dict(name="Bench", email="bench@localhost", password="bench", password2="bench"))
+    for i in range(3):
+        client.post("/account_create", data=dict(name=f"Company {i}"))
+    for account_id in range(2, 5):
+        for i in range(5):
+            client.post(f"/account/{account_id}/invite", data=dict(email=f"invitee{i}@localhost", role="user"))
+
+    print(line.format("authenticated GET /:", *measure_requests(client, "get", "/")))
+    print(line.format("authenticated GET /account:", *measure_requests(client, "get", "/account")))
+    headers = {"If-None-Match": client.get("/account").headers["ETag"]}
+    print(line.format("  not modified (304):", *measure_requests(client, "get", "/account", headers=headers)))
+    print("  session cache: {hits} hits, {misses} misses".format(**User.session_cache.stats()))
+    print(f"  identity map: {identity_map.avoided_fetch_count} fetches avoided")
+
+
+def bench_account_db_creation(data_dir, repeat=20):
+    """Compare replaying the migrations on each new account database against copying a template database"""
+    import migrate
+
+    print("Account database creation:")
+    for migration_count in (1, 10, 100):
+        migrations = [
+            migrate.Migration(i, f"{i:05}_bench.sql", f"CREATE TABLE bench_{i} (id INTEGER PRIMARY KEY);", str(i))
+            for i in range(1, migration_count + 1)
+        ]
+        bench_dir = data_dir / f"bench_{migration_count}"
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = perf_counter()
+            for i in range(repeat):
+                migrate.migrate(bench_dir / f"replay_{i}.db", migrations)
+            replay_time = perf_counter() - start_time
+
+            migrate.migrate(bench_dir / "template.db", migrations)
+            start_time = perf_counter()
+            for i in range(repeat):
+                shutil.copyfile(bench_dir / "template.db", bench_dir / f"copy_{i}.db")
+            copy_time = perf_counter() - start_time
+        print(f"  {migration_count:3} migrations: replay {replay_time * 1000 / repeat:8.3f} ms, "
+              f"template copy {copy_time * 1000 / repeat:8.3f} ms")
+
+
+def bench_write_behind(flask_app, repeat=500):
+    """Compare writing the last login time of users one transaction at a time against the write-behind buffer"""
+    from datetime import datetime
+
+    from db.models.auth.user import User
+    from db.write_behind import WriteBehindBuffer
+
+    print("Last login updates:")
+    with flask_app.app_context():
+        users = User.select()
+        start_time = perf_counter()
+        for i in range(repeat):
+            users[i % len(users)].update(last_login=datetime.now())
+        print(f"  update:       {(perf_counter() - start_time) * 1000 / repeat:8.3f} ms per login")
+
+        buffer = WriteBehindBuffer(flush_interval=3600)
+        with patch("db.write_behind.buffer", buffer):
+            start_time = perf_counter()
+            for i in range(repeat):
+                users[i % len(users)].update_later(last_login=datetime.now())
+            buffer.flush()
+        print(f"  update_later: {(perf_counter() - start_time) * 1000 / repeat:8.3f} ms per login, "
+              f"{buffer.write_count} rows written in {buffer.flush_count} transaction")
+
+
+def bench_guest_creation(flask_app, repeat=100):
+    """Measure the creation of guest users: user, personal account and its database file, membership and session"""
+    from db import connection
+    from db.models.auth.user import User
+
+    statements = []
+
+    def connect_and_trace(db_file_name):
+        con = connect_to_db(db_file_name)
+        con.set_trace_callback(statements.append)
+        return con
+
+    connect_to_db = connection.connect_to_db
+    with patch("db.connection.connect_to_db", connect_and_trace):
+        start_time = perf_counter()
+        for _ in range(repeat):
+            with flask_app.test_request_context():
+                User.create_guest_and_login()
+        elapsed = perf_counter() - start_time
+    commit_count = sum(statement == "COMMIT" for statement in statements)
+    print(f"Guest creation: {commit_count / repeat:.1f} commits, {elapsed * 1000 / repeat:.3f} ms per guest")
+
+
+def bench_invitations(flask_app, invitation_count=200):
+    """Compare inviting users with one request each against a single request to the bulk invite endpoint"""
+    from db.models.auth.user import User
+
+    client = flask_app.test_client()
+    client.post("/signup", data=dict(name="Bench", email="bench-invite@localhost", password="bench", password2="bench"))
+    for i in range(2):
+        client.post("/account_create", data=dict(name=f"Invitations {i}"))
+    with flask_app.app_context():
+        user = User.select_one(email="bench-invite@localhost")
+        account_ids = [user_account.account_id for user_account in user.user_account_set[-2:]]
+    emails = [f"invitee{i}@localhost" for i in range(invitation_count)]
+
+    start_time = perf_counter()
+    for email in emails:
+        client.post(f"/account/{account_ids[0]}/invite", data=dict(email=email, role="user"))
+    one_by_one_time = perf_counter() - start_time
+    start_time = perf_counter()
+    client.post(f"/account/{account_ids[1]}/invite_many", json=dict(emails=emails, role="user"))
+    bulk_time = perf_counter() - start_time
+    print(f"Invitation of {invitation_count} users: one request each {one_by_one_time * 1000:.0f} ms, "
+          f"one bulk request {bulk_time * 1000:.0f} ms")
+
+
+def bench_password_hashing(flask_app, login_count=32, threads=8):
+    """Latency of a cheap request during a burst of logins, hashing in the request threads or in the process pool"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from passwords import hasher
+
+    flask_app.test_client().post(
+        "/signup", data=dict(name="Bench", email="bench-hash@localhost", password="bench", password2="bench")
+    )
+
+    def login(_):
+        flask_app.test_client().post("/login", data=dict(email="bench-hash@localhost", password="bench"))
+
+    print(f"Burst of {login_count} logins from {threads} threads:")
+    config = flask_app.config
+    for workers in (0, config["PASSWORD_HASH_WORKERS"]):
+        hasher.configure(config["PASSWORD_HASH_METHOD"], workers, max_queue=login_count)
+        login(None)  # Start the worker processes
+        client = flask_app.test_client()
+        client.get("/")
+        latencies = []
+        start_time = perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            burst = executor.map(login, range(login_count))
+            for _ in range(20):
+                request_start_time = perf_counter()
+                client.get("/")
+                latencies.append(perf_counter() - request_start_time)
+            list(burst)
+        burst_time = perf_counter() - start_time
+        print(f"  {workers} workers: burst {burst_time * 1000:6.0f} ms, "
+              f"GET / during the burst {sum(latencies) / len(latencies) * 1000:6.2f} ms on average")
+
+
+def bench_rate_limiter(flask_app, repeat=2000):
+    """Cost of a rate limited request, before anything else is done, with both backends"""
+    from ratelimit import limiter
+
+    print("Rate limiter:")
+    with flask_app.app_context():
+        for backend in ("memory", "sqlite"):
+            limiter.configure(backend, flask_app.config["DATA_DIR"] / "rate_limits.db", {"ip": (repeat, 60)})
+            start_time = perf_counter()
+            for i in range(repeat):
+                limiter.hit("ip", f"10.0.{i % 256}.{i // 256}")
+            print(f"  {backend:6}  {(perf_counter() - start_time) / repeat * 1e6:8.1f} µs per request")
+    limiter.configure(None, None, {})
+
+
+def bench_static_assets(flask_app, repeat=200):
+    """Bytes sent for the stylesheet per variant, and time to serve it"""
+    from blueprints.assets import brotli
+
+    client = flask_app.test_client()
+    (css_url,) = re.findall(r'href="([^"]+\.css)"', client.get("/").text)
+    print(f"Static assets ({css_url}):")
+    for accept_encoding in ("identity", "gzip") + (("br",) if brotli else ()):
+        start_time = perf_counter()
+        for _ in range(repeat):
+            response = client.get(css_url, headers={"Accept-Encoding": accept_encoding})
+        elapsed = (perf_counter() - start_time) / repeat
+        print(f"  {accept_encoding:9} {len(response.data):7} bytes, {elapsed * 1000:6.3f} ms")
+    response = client.get(
+        css_url, headers={"Accept-Encoding": accept_encoding, "If-None-Match": response.headers["ETag"]}
+    )
+    print(f"  revalidation: {response.status_code}, cached for {response.headers['Cache-Control']}")
+
+
+def bench_bulk_writes(flask_app, row_count=1000):
+    """Compare writing invitations one row per transaction against the bulk writes, one transaction for all rows"""
+    from db.models.auth.invitation import Invitation
+    from db.models.auth.user import User
+
+    print(f"Bulk writes of {row_count} invitations:")
+    line = "  {:6}  one by one {:8.0f} rows/s, bulk {:8.0f} rows/s"
+    with flask_app.app_context():
+        user = User.get_by_id(User.insert(name="Bench bulk", email=None, password=None))
+        rows = [
+            dict(email=f"bulk{i}@localhost", created_by=user.id, account_id=user.current_account_id, role="user")
+            for i in range(row_count)
+        ]
+
+        loop_times = {}
+        start_time = perf_counter()
+        for row in rows:
+            Invitation.insert(**row)
+        loop_times["insert"] = perf_counter() - start_time
+        ids = [invitation.id for invitation in Invitation.select(account_id=user.current_account_id)]
+        start_time = perf_counter()
+        for id in ids:
+            Invitation.update_by_id(id, status="declined")
+        loop_times["update"] = perf_counter() - start_time
+        start_time = perf_counter()
+        for id in ids:
+            Invitation.delete_by_id(id)
+        loop_times["delete"] = perf_counter() - start_time
+
+        bulk_times = {}
+        start_time = perf_counter()
+        Invitation.insert_many(rows)
+        bulk_times["insert"] = perf_counter() - start_time
+        start_time = perf_counter()
+        Invitation.update_where({"account_id": user.current_account_id}, status="declined")
+        bulk_times["update"] = perf_counter() - start_time
+        start_time = perf_counter()
+        Invitation.delete_where(account_id=user.current_account_id)
+        bulk_times["delete"] = perf_counter() - start_time
+
+    for statement in ("insert", "update", "delete"):
+        print(line.format(statement, row_count / loop_times[statement], row_count / bulk_times[statement]))
+
+
+def bench_models(flask_app, row_count=10000, repeat=5):
+    """Measure how fast rows are turned into model instances, and how much memory the instances take"""
+    from datetime import datetime
+
+    from db.models.auth.session import Session
+    from db.models.auth.user import User
+
+    print("Model instances:")
+    with flask_app.app_context():
+        user_id = User.insert(name="Bench models", email=None, password=None)
+        con = Session.connect_to_db()
+        with con:
+            con.executemany(
+                "INSERT INTO session (user_id, secret, expires) VALUES (?, ?, ?)",
+                ((user_id, Session.generate_secret(), datetime.now().isoformat(" ")) for _ in range(row_count)),
+            )
+
+    elapsed = 0
+    for _ in range(repeat):
+        # A new app context for each select, so that the rows are not in the identity map yet
+        with flask_app.app_context():
+            start_time = perf_counter()
+            sessions = Session.select(user_id=user_id)
+            elapsed += perf_counter() - start_time
+    print(f"  select: {row_count * repeat / elapsed:10.0f} rows/s")
+
+    with flask_app.app_context():
+        start_time = perf_counter()
+        for _ in range(row_count):
+            Session.count(user_id=user_id, id=1)
+        print(f"  count:  {row_count / (perf_counter() - start_time):10.0f} queries/s")
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        sessions = Session.select(user_id=user_id)
+        memory = tracemalloc.get_traced_memory()[0] - memory_before
+        tracemalloc.stop()
+
+    instance_size = sys.getsizeof(sessions[0])
+    if hasattr(sessions[0], "__dict__"):
+        instance_size += sys.getsizeof(sessions[0].__dict__)
+    print(f"  {instance_size} bytes per instance, {memory / len(sessions):.0f} bytes per instance with its values")
+    del sessions
+
+    # Peak memory of going through all the rows, each in a new app context so that no row is in the identity map
+    tracemalloc.start()
+    with flask_app.app_context():
+        for session in Session.select(user_id=user_id):
+            pass
+    select_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    with flask_app.app_context(), Session.stream(user_id=user_id) as streamed_sessions:
+        for session in streamed_sessions:
+            pass
+    stream_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  peak memory going through all the rows: select {select_peak / 1024:.0f} KiB, "
+          f"stream {stream_peak / 1024:.0f} KiB")
+
+
+def run():
+    import migrate
+
+    data_dir = Path(tempfile.mkdtemp(prefix="bench_data"))
+    try:
+        flask_app = app.create_app(
+            {
+                "TESTING": True,
+                "DATA_DIR": data_dir,
+                "EMAIL_TRANSPORT": "file",
+                "EMAIL_WORKER": False,
+                # The benchmarks log in much more often than the rate limits allow
+                "RATE_LIMIT_BACKEND": None,
+            }
+        )
+        with flask_app.app_context():
+            migrate.run()
+        bench_requests(flask_app)
+        bench_account_db_creation(data_dir)
+        bench_write_behind(flask_app)
+        bench_guest_creation(flask_app)
+        bench_invitations(flask_app)
+        bench_password_hashing(flask_app)
+        bench_rate_limiter(flask_app)
+        bench_static_assets(flask_app)
+        bench_bulk_writes(flask_app)
+        bench_models(flask_app)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,101 @@
+"""Static files served under a name containing the hash of their content, like /assets/css/style.0123456789ab.css.
+
+Their URL changes with their content, so browsers can cache them forever (Cache-Control: immutable) and never even
+revalidate them. Templates link them with asset_url("css/style.css"). The files of the static folder are hashed, and the
+text ones compressed with gzip (and brotli, if the brotli or brotlicffi module is installed), once when the app starts:
+each request gets the best variant accepted by its Accept-Encoding, without compressing anything.
+
+In debug mode, asset_url links the files of the static folder directly, with their modification time to reload them."""
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+
+from flask import Blueprint, Response, abort, current_app, request, url_for
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli  # Same API, for PyPy and the platforms without brotli wheels
+    except ImportError:
+        brotli = None
+
+assets = Blueprint("assets", __name__)
+
+# Files compressed when the app starts, if it makes them smaller
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Variants preferred when the client accepts several of them
+ENCODINGS = ("br", "gzip")
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class Asset:
+    __slots__ = ("filename", "hashed_filename", "etag", "mimetype", "variants")
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.etag = hashlib.sha256(content).hexdigest()[:12]
+        stem, dot, suffix = filename.rpartition(".")
+        self.hashed_filename = f"{stem}.{self.etag}.{suffix}" if dot else f"{filename}.{self.etag}"
+        self.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.variants = {None: content}  # {Content-Encoding: content}
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            compressed = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(content)
+            for encoding, variant in compressed.items():
+                if len(variant) < len(content):
+                    self.variants[encoding] = variant
+
+    def variant(self, accept_encodings):
+        """Return (Content-Encoding, content) of the preferred variant in accept_encodings"""
+        for encoding in ENCODINGS:
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding, self.variants[encoding]
+        return None, self.variants[None]
+
+
+def load_assets(static_folder):
+    """Return the {filename: Asset} and {hashed_filename: Asset} of all the files of the static folder"""
+    by_filename = {}
+    for path in sorted(Path(static_folder).rglob("*")):
+        if path.is_file():
+            asset = Asset(path.relative_to(static_folder).as_posix(), path.read_bytes())
+            by_filename[asset.filename] = asset
+    return by_filename, {asset.hashed_filename: asset for asset in by_filename.values()}
+
+
+@assets.record_once
+def load_static_folder(state):
+    state.app.extensions["assets"] = load_assets(state.app.static_folder)
+
+
+@assets.app_template_global()
+def asset_url(filename):
+    """Return the URL of the static file filename, which changes with its content"""
+    if current_app.debug:
+        mtime = int(os.path.getmtime(os.path.join(current_app.static_folder, filename)))
+        return url_for("static", filename=filename, v=mtime)
+    asset = current_app.extensions["assets"][0].get(filename)
+    if asset is None:
+        return url_for("static", filename=filename)
+    return url_for("assets.asset", hashed_filename=asset.hashed_filename)
+
+
+@assets.route("/assets/<path:hashed_filename>")
+def asset(hashed_filename):
+    asset = current_app.extensions["assets"][1].get(hashed_filename)
+    if asset is None:
+        abort(404)
+    encoding, content = asset.variant(request.accept_encodings)
+    response = Response(content, mimetype=asset.mimetype)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    if len(asset.variants) > 1:
+        response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    # Each variant has its own ETag, since its bytes differ
+    response.set_etag(f"{asset.etag}-{encoding}" if encoding else asset.etag)
+    return response.make_conditional(request)
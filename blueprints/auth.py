@@ -1,16 +1,51 @@
+import re
 from datetime import datetime
 
-from flask import current_app, session, redirect, request, render_template, flash, Blueprint, g, url_for
-from werkzeug.security import check_password_hash
+from flask import current_app, session, redirect, request, render_template, flash, Blueprint, g, url_for, jsonify
 
-from blueprints.email import send_email
+from blueprints.conditional import conditional
+from blueprints.email import send_email, send_emails
+from db import write_behind
+from db.models.auth.account import Account
 from db.models.auth.session import Session
-from db.models.auth.user import User
+from db.models.auth.user import User, GuestUser
 from db.models.auth.user_account import UserAccount
 from db.models.auth.invitation import Invitation
+from passwords import hasher
+from ratelimit import limiter
 
 auth = Blueprint("auth", __name__, template_folder="templates")
 
+# Endpoints saving the work of the visitor: a guest user is created in the database for them, if needed. The GET
+# requests don't write anything for visitors without session (crawlers, bots...)
+GUEST_ENDPOINTS = ("auth.signup",)
+
+# Endpoints posted to by visitors without session, without creating a guest. Their other POST requests (forms of the
+# logged in users, posted by bots...) are redirected to the login page.
+VISITOR_ENDPOINTS = (
+    "auth.login",
+    "auth.forgotten_password",
+    "auth.reset_password",
+    "auth.invitation_accept",
+    "auth.invitation_decline",
+)
+
+
+# Endpoints hashing passwords, writing to auth.db or sending emails, whose POST requests are rate limited
+RATE_LIMITED_ENDPOINTS = ("auth.login", "auth.signup", "auth.forgotten_password", "auth.reset_password")
+
+
+# Registered first, to run before the other functions, so that limited requests don't read the session
+@auth.before_app_request
+def rate_limit_auth_endpoints():
+    if request.method != "POST" or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return
+    # Behind a reverse proxy, remote_addr must be set from X-Forwarded-For by werkzeug's ProxyFix
+    limiter.hit("ip", request.remote_addr)
+    email = request.form.get("email")
+    if email:
+        limiter.hit("email", email.strip().lower())
+
 
 # Run this function before every request
 @auth.before_app_request
@@ -18,20 +53,36 @@ def create_guest_session_if_needed():
     from db.models.auth.account import Account
     from db.models.auth.user import User
 
+    if request.endpoint in ("static", "assets.asset"):
+        # Static files don't depend on the user: no need to read the session, nor to vary with the Cookie header
+        return
+
     SESSION_SECRET_KEY = current_app.config["SESSION_SECRET_KEY"]
 
     user = None
 
     if SESSION_SECRET_KEY in session:
-        # Returns None if session_secret is invalid or expired
-        user = User.get_by_session_secret(session[SESSION_SECRET_KEY])
+        if current_app.config["SIGNED_SESSION_TTL"]:
+            # Trust the recently signed session without reading auth.db, or check it against the session table again
+            user = User.get_by_signed_session() or User.get_by_session_secret_and_sign(session[SESSION_SECRET_KEY])
+        else:
+            # Returns None if session_secret is invalid or expired
+            user = User.get_by_session_secret(session[SESSION_SECRET_KEY])
 
     if user is None:
         if SESSION_SECRET_KEY in session:
             # Session is expired
             flash("Your session has expired. When using the app as guest, remember to sign in to save your work.")
+            session.pop(SESSION_SECRET_KEY)
 
-        user = User.create_guest_and_login()
+        if request.method == "POST" and request.endpoint in GUEST_ENDPOINTS:
+            user = User.create_guest_and_login()
+        else:
+            user = GuestUser()
+            if request.method == "POST" and request.endpoint not in VISITOR_ENDPOINTS:
+                g.user, g.account = user, None
+                flash("Please log in first")
+                return redirect(url_for("auth.login"))
 
     g.user = user
 
@@ -44,10 +95,10 @@ def create_guest_session_if_needed():
     g.account = user.current_account
 
     # Let's change the current account to the one they're trying to access
-    if account_id and account_id != user.current_account.id:
+    if account_id and account_id != user.current_account_id:
         # Let's make sure the user has access to the account they're trying to access
         if account_id in [account.id for account in user.account_set]:
-            user.update(current_account_id=account_id)
+            user.update_later(current_account_id=account_id)
             g.account = Account.get_by_id(account_id)
         else:
             flash("You don't have access to that account")
@@ -103,18 +154,8 @@ def signup():
             else:
                 # Actually update the current guest user with the actual user data
                 hashed_password = User.generate_password_hash(password)
-                with con:
-                    con.execute(
-                        """UPDATE user SET email = ?, name = ?, password_hash = ? WHERE id = ?""",
-                        (
-                            email,
-                            name,
-                            hashed_password,
-                            g.user.id,
-                        ),
-                    )
+                g.user.update(email=email, name=name, password_hash=hashed_password)
                 # No need to update the session since the user is already logged in
-                con.close()
                 # But don't forget to update g.user
                 g.user = User.get_by_id(g.user.id)
                 flash("Account created. Welcome! 🎉")
@@ -187,11 +228,14 @@ def logout():
 
 
 @auth.route("/account", methods=["GET"])
+@conditional
 def account():
     if g.user.email:
         # Only display account to non-guest users
         active_tab = request.args.get('tab', 'account-tab-pane')
-        return render_template("auth/account.html", active_tab=active_tab)
+        # Everything the template reads from the accounts, in a constant number of queries
+        accounts = Account.prefetch(g.user.account_set, "user_account_set__user", "invitation_set")
+        return render_template("auth/account.html", active_tab=active_tab, accounts=accounts)
     return redirect(url_for("auth.login", next=url_for("auth.account")))
 
 
@@ -212,7 +256,7 @@ def user_update_password():
 
     # Check old password
     if old_password:
-        if check_password_hash(g.user.password_hash, old_password):
+        if hasher.check(g.user.password_hash, old_password):
             pass  # Old password is present and correct
         else:
             errors.append("Old password is incorrect")
@@ -286,8 +330,8 @@ def account_delete(account_id):
     account = Account.get_by_id(account_id)
 
     # Make sure each user has at least one account left
-    for user in account.user_set:
-        user_account_count = len(UserAccount.select(user_id=user.id))
+    for user in User.prefetch(account.user_set, "user_account_set"):
+        user_account_count = len(user.user_account_set)
         if user_account_count <= 1:
             if user.id == g.user.id:
                 who = "you"
@@ -300,10 +344,15 @@ def account_delete(account_id):
             flash(constraint)
         return redirect(url_for("auth.account"))
 
-    # Before deleting the account, assign all users that have it as their current account to a different account
+    # Before deleting the account, assign all users that have it as their current account to a different account,
+    # with one update per account they're assigned to. Recent account switches may still be in the write-behind buffer.
+    write_behind.buffer.flush()
+    user_ids_by_account_id = {}
     for user in account.current_user_set:
         user_account = UserAccount.select_excluding_account(exclude_account_id=account_id, user_id=user.id)[0]
-        user.update(current_account_id=user_account.account_id)
+        user_ids_by_account_id.setdefault(user_account.account_id, []).append(user.id)
+    for new_account_id, user_ids in user_ids_by_account_id.items():
+        User.update_where({"id": user_ids}, current_account_id=new_account_id)
 
     account.delete()
 
@@ -411,6 +460,52 @@ def account_invite(account_id):
     return redirect(url_for("auth.account"))
 
 
+@auth.route("/account/<int:account_id>/invite_many", methods=["POST"])
+def account_invite_many(account_id):
+    """Invite many users to join an account at once, from the emails of a form's textarea, or from a JSON body like
+    {"emails": [...], "role": "user"}, to which the response is {"results": [{"email": ..., "result": ...}, ...]}"""
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        emails, role = data.get("emails"), data.get("role")
+    else:
+        emails, role = re.split(r"[\s,;]+", request.form.get("emails", "")), request.form.get("role")
+
+    def error(message, status):
+        if request.is_json:
+            return jsonify(error=message), status
+        flash(message)
+        return redirect(url_for("auth.account"))
+
+    if not UserAccount.select(user_id=g.user.id, account_id=account_id, role="admin"):
+        return error("You don't have permission to invite users to this account", 403)
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails) or not any(emails):
+        return error("You must enter at least one email address", 400)
+    if role not in UserAccount.role_choices:
+        return error(f"Invalid role. Should be one of {', '.join(UserAccount.role_choices)}", 400)
+
+    results, invitations = Invitation.insert_for_emails(account_id, emails, role, created_by=g.user.id)
+
+    # The template is compiled once, and rendered for each invitation
+    APP_NAME = current_app.config["APP_NAME"]
+    template = current_app.jinja_env.get_template("auth/invitation_email.html")
+    send_emails(
+        (
+            invitation.email,
+            f"You have been invited to join an account on {APP_NAME}",
+            render_template(template, invitation=invitation, app_name=APP_NAME),
+        )
+        for invitation in invitations
+    )
+
+    if request.is_json:
+        return jsonify(results=[dict(email=email, result=result) for email, result in results.items()])
+    flash(f"{len(invitations)} invitation(s) sent! 🎉" if invitations else "No invitation sent")
+    for email, result in results.items():
+        if result != "invited":
+            flash(f"{email}: {result}")
+    return redirect(url_for("auth.account"))
+
+
 @auth.route("/invitation/<secret>", methods=["GET"])
 def invitation(secret):
     invitation = Invitation.get_by_secret(secret)
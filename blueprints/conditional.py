@@ -0,0 +1,70 @@
+"""Conditional GET of the pages rendered for the current user.
+
+The ETag of a page is a hash of what it's built from: the user, the versions of the user and of its accounts kept by the
+change_counter table, the user's updates still in the write-behind buffer, the URL with its query string, and the
+templates and static files of the app. When the browser already has this version of the page (If-None-Match), the view
+isn't even called: no query besides the versions, no template rendered, 304 Not Modified.
+
+Pages with flashed messages pending are always rendered, since displaying them changes the session."""
+import hashlib
+from functools import wraps
+from pathlib import Path
+
+from flask import current_app, g, make_response, request, session
+from flask.globals import request_ctx
+
+from db import write_behind
+
+
+def app_fingerprint(flask_app):
+    """Return the hash of the templates and static files of flask_app, computed once: pages change with them"""
+    fingerprint = flask_app.extensions.get("conditional_fingerprint")
+    if fingerprint is None:
+        digest = hashlib.sha256()
+        for folder in (flask_app.template_folder, flask_app.static_folder):
+            folder = Path(flask_app.root_path, folder)
+            for path in sorted(folder.rglob("*")):
+                if path.is_file():
+                    digest.update(path.relative_to(folder).as_posix().encode())
+                    digest.update(path.read_bytes())
+        fingerprint = flask_app.extensions["conditional_fingerprint"] = digest.hexdigest()
+    return fingerprint
+
+
+def page_etag():
+    """Return the ETag of the page requested by the current user"""
+    from db.models.auth.change_counter import ChangeCounter
+    from db.models.auth.user import User
+
+    flask_app = current_app._get_current_object()
+    user_id = g.user.id
+    if user_id is None:  # Guests not saved yet see the same pages
+        versions, pending = (), None
+    else:
+        versions, pending = ChangeCounter.versions_of_user(user_id), write_behind.buffer.pending(User, user_id)
+    token = repr((app_fingerprint(flask_app), flask_app.debug, request.full_path, user_id, versions, pending))
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def conditional(view):
+    """Answer the GET requests of view with 304 when the browser has the current version of the page"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+            return view(*args, **kwargs)
+
+        etag = page_etag()
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or request_ctx.flashes:
+                # Messages flashed and displayed by the view itself are only displayed once
+                return response
+        response.set_etag(etag)
+        # Stored by the browser only, and revalidated each time
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    return wrapper
@@ -1,22 +1,150 @@
+"""Emails are never sent during requests: send_email() stores them in the email_outbox table, and the outbox worker
+delivers them in the background through the EMAIL_TRANSPORT of the config, retrying the failed deliveries."""
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 from flask import Blueprint, current_app
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
+from db.models.auth.outbox_email import OutboxEmail
+
 email = Blueprint("email", __name__, template_folder="templates")
 
 
+class SendGridTransport:
+    def __init__(self, config):
+        self.from_email = config["FROM_EMAIL"]
+        # The client, and its HTTP connection pool, is shared by all the deliveries
+        self.client = SendGridAPIClient(config["SENDGRID_API_KEY"])
+
+    def send(self, outbox_email):
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=outbox_email.to_email,
+            subject=outbox_email.subject,
+            html_content=outbox_email.html_content,
+        )
+        return self.client.send(message)
+
+
+class FileTransport:
+    """Write each email to a file of the EMAIL_FILE_SINK_DIR directory instead of sending it, for development and
+    tests"""
+
+    def __init__(self, config):
+        self.directory = Path(config["EMAIL_FILE_SINK_DIR"] or config["DATA_DIR"] / "outbox")
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def send(self, outbox_email):
+        (self.directory / f"{outbox_email.id}.html").write_text(
+            f"To: {outbox_email.to_email}\nSubject: {outbox_email.subject}\n\n{outbox_email.html_content}"
+        )
+
+
+# Possible EMAIL_TRANSPORT config values
+TRANSPORTS = {"sendgrid": SendGridTransport, "file": FileTransport}
+
+
+def get_transport(flask_app):
+    """Return the transport of the app, built once"""
+    transport = flask_app.extensions.get("email_transport")
+    if transport is None:
+        transport = flask_app.extensions["email_transport"] = TRANSPORTS[flask_app.config["EMAIL_TRANSPORT"]](
+            flask_app.config
+        )
+    return transport
+
+
+class OutboxWorker:
+    """Delivers the emails of the outbox from a background thread, started by create_app() when EMAIL_WORKER is set.
+    Also run by `python maintenance.py deliver-emails`, to deliver them from a separate process instead.
+
+    Threads don't survive a fork: when the app is loaded before forking the worker processes (gunicorn --preload),
+    each of them starts its own thread on its first wake() (the emails are claimed by one of them only)."""
+
+    def __init__(self):
+        self.sent_count = 0
+        self.failed_count = 0  # Failed attempts, including the ones that will be retried
+        self._thread = None
+        self._thread_pid = None  # Process running the thread
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def wake(self, flask_app):
+        """Deliver the emails now, starting the worker thread if needed"""
+        if not flask_app.config["EMAIL_WORKER"]:
+            return
+        with self._lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                self._wake = threading.Event()
+                self._thread = threading.Thread(target=self.run, args=(flask_app,), name="email-outbox", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def deliver(self, flask_app):
+        """Deliver the emails due, EMAIL_CONCURRENCY at a time, until none is left. Returns the number sent."""
+        config = flask_app.config
+        transport = get_transport(flask_app)
+
+        def send(outbox_email):
+            try:
+                transport.send(outbox_email)
+            except Exception as exception:
+                return f"{type(exception).__name__}: {exception}"
+            return None
+
+        sent_count = 0
+        with flask_app.app_context(), ThreadPoolExecutor(config["EMAIL_CONCURRENCY"]) as executor:
+            while True:
+                outbox_emails = OutboxEmail.claim_due(limit=config["EMAIL_CONCURRENCY"] * 10)
+                if not outbox_emails:
+                    return sent_count
+                for outbox_email, error in zip(outbox_emails, executor.map(send, outbox_emails)):
+                    if error is None:
+                        outbox_email.mark_sent()
+                        sent_count += 1
+                        self.sent_count += 1
+                    else:
+                        outbox_email.mark_failed(error, config["EMAIL_MAX_ATTEMPTS"], config["EMAIL_RETRY_DELAY"])
+                        self.failed_count += 1
+
+    def run(self, flask_app):
+        while True:
+            self._wake.clear()
+            try:
+                self.deliver(flask_app)
+            except Exception:
+                traceback.print_exc()
+            # Woken up by send_email(), or every EMAIL_POLL_INTERVAL seconds for the retries
+            self._wake.wait(flask_app.config["EMAIL_POLL_INTERVAL"])
+
+
+outbox_worker = OutboxWorker()
+
+
 def send_email(to, subject, html_content):
-    SENDGRID_API_KEY = current_app.config["SENDGRID_API_KEY"]
-    FROM_EMAIL = current_app.config["FROM_EMAIL"]
+    """Queue the email in the outbox, to be delivered by the outbox worker. Returns its id."""
     APP_NAME = current_app.config["APP_NAME"]
 
-    message = Mail(
-        from_email=FROM_EMAIL,
-        to_emails=to,
-        subject=f"[{APP_NAME}] {subject}",
-        html_content=html_content,
-    )
+    email_id = OutboxEmail.insert(to_email=to, subject=f"[{APP_NAME}] {subject}", html_content=html_content)
+    outbox_worker.wake(current_app._get_current_object())
+    return email_id
+
 
-    sg = SendGridAPIClient(SENDGRID_API_KEY)
-    response = sg.send(message)
-    return response
+def send_emails(emails):
+    """Queue the (to, subject, html_content) emails in the outbox with a single statement, and wake the outbox worker
+    once. Returns the number of emails queued."""
+    APP_NAME = current_app.config["APP_NAME"]
+
+    count = OutboxEmail.insert_many(
+        dict(to_email=to, subject=f"[{APP_NAME}] {subject}", html_content=html_content)
+        for to, subject, html_content in emails
+    )
+    if count:
+        outbox_worker.wake(current_app._get_current_object())
+    return count
@@ -0,0 +1 @@
+from db.connection import transaction
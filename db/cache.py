@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+# All the caches created, so that they can be cleared at once (e.g. between tests)
+caches = []
+
+
+class TTLCache:
+    """Thread-safe in-process cache, keeping at most max_size entries, each of them for at most ttl seconds.
+    The least recently used entries are evicted first when the cache is full.
+
+    Each process has its own cache: entries changed by another process are stale for up to ttl seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {key: (expires, value)}
+        self._lock = threading.Lock()
+        caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Cache value for ttl seconds, or for the cache's ttl if it's shorter or not given"""
+        if self.max_size <= 0:
+            return  # Cache disabled
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_values(self, value):
+        """Remove all the entries whose value is value"""
+        with self._lock:
+            for key in [key for key, (_, entry_value) in self._entries.items() if entry_value == value]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def clear_caches():
+    for cache in caches:
+        cache.clear()
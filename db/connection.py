@@ -1,17 +1,159 @@
+import re
 import sqlite3
-from flask import current_app
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context
+
+# PRAGMAs of the [sqlite] config.ini section that are applied to each connection.
+# journal_mode is persistent, so it's only set by migrate.py.
+CONNECTION_PRAGMAS = ("synchronous", "mmap_size", "cache_size", "temp_store", "busy_timeout")
+PERSISTENT_PRAGMAS = ("journal_mode",)
+
+
+def parse_sqlite_pragmas(section):
+    """Validate the {pragma: value} of the [sqlite] config.ini section, since they end up in SQL statements"""
+    pragmas = {}
+    for pragma, value in section.items():
+        if pragma not in CONNECTION_PRAGMAS + PERSISTENT_PRAGMAS:
+            raise Exception(f"Unsupported {pragma} setting in config.ini's sqlite section.")
+        if not re.fullmatch(r"-?\w+", value):
+            raise Exception(f"Invalid {pragma} value in config.ini's sqlite section: {value}")
+        pragmas[pragma] = value
+    return pragmas
 
 
 class MyConnect(sqlite3.Connection):
+    # Number of connections opened since the process started, used to measure connection reuse
+    open_count = 0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        MyConnect.open_count += 1
+        self.transaction_depth = 0  # Number of nested with statements on the connection
         self.row_factory = sqlite3.Row
         # Only in debug mode
         if current_app and current_app.config["DEBUG"]:
             self.set_trace_callback(print)
         with self:
             self.execute("PRAGMA foreign_keys = ON")
+            if current_app:
+                for pragma, value in current_app.config["SQLITE_PRAGMAS"].items():
+                    if pragma in CONNECTION_PRAGMAS:
+                        self.execute(f"PRAGMA {pragma} = {value}")
+
+    def __enter__(self):
+        self.transaction_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Commit, or roll back on exception, when leaving the outermost with statement only: the nested ones are part
+        of the same transaction. An exception caught within the transaction doesn't undo the writes made before it."""
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            return super().__exit__(exc_type, exc_value, traceback)
+        return False
 
 
 def connect_to_db(db_file_name):
     return MyConnect(db_file_name)
+
+
+# Connections used outside of an app context (scripts, tests) are kept per thread
+_thread_local = threading.local()
+
+
+def _context():
+    """Return the namespace holding the connections of the current app context, or of the current thread."""
+    return g if has_app_context() else _thread_local
+
+
+def _connections():
+    """Return the {db_file_name: connection} dict of the current app context, or of the current thread."""
+    context = _context()
+    if not hasattr(context, "db_connections"):
+        context.db_connections = {}
+    return context.db_connections
+
+
+def get_connection(db_file_name):
+    """Return a connection to db_file_name, shared by all the queries of the current app context (or thread).
+    The same connection is returned until close_connections() is called."""
+    connections = _connections()
+    key = str(db_file_name)
+    con = connections.get(key)
+    if con is None:
+        con = connections[key] = connect_to_db(db_file_name)
+        transaction_connections = getattr(_context(), "db_transaction", None)
+        if transaction_connections is not None:
+            # Join the current unit of work
+            con.__enter__()
+            transaction_connections.append(con)
+    return con
+
+
+@contextmanager
+def transaction():
+    """Unit of work: all the queries made with the shared connections (see get_connection), and thus by the models,
+    within the with statement are made in a single transaction per database, committed once at the end, or rolled
+    back if an exception is raised. Nested units of work are part of the enclosing one.
+
+    The databases are committed one after the other: a transaction spanning several database files isn't atomic."""
+    context = _context()
+    if getattr(context, "db_transaction", None) is not None:
+        yield
+        return
+
+    context.db_transaction = transaction_connections = []
+    context.db_transaction_uncached = uncached = set()
+    try:
+        for con in _connections().values():
+            con.__enter__()
+            transaction_connections.append(con)
+        try:
+            yield
+        except BaseException as exception:
+            context.db_transaction = None
+            for con in transaction_connections:
+                con.__exit__(type(exception), exception, exception.__traceback__)
+            raise
+
+        context.db_transaction = None
+        commit_error = None
+        for con in transaction_connections:
+            if commit_error is None:
+                try:
+                    con.__exit__(None, None, None)
+                    continue
+                except sqlite3.Error as exception:
+                    commit_error = exception
+            # Roll back the databases not committed yet
+            con.rollback()
+        if commit_error is not None:
+            raise commit_error
+    finally:
+        context.db_transaction = context.db_transaction_uncached = None
+        # Evict the rows written again, once committed or rolled back: other threads may have cached them meanwhile
+        for model, id in uncached:
+            model.uncache(id)
+
+
+def in_transaction():
+    """Return whether a unit of work is in progress: rows read now may be rolled back, and must not be cached"""
+    return getattr(_context(), "db_transaction", None) is not None
+
+
+def uncached_in_transaction(model, id):
+    """Remember that the row id of model was written in the unit of work in progress, if any, to evict it again from
+    the caches when it ends"""
+    uncached = getattr(_context(), "db_transaction_uncached", None)
+    if uncached is not None:
+        uncached.add((model, id))
+
+
+def close_connections(exception=None):
+    """Close all the connections of the current app context (or thread). Registered as an app teardown hook."""
+    connections = _connections()
+    while connections:
+        _, con = connections.popitem()
+        con.close()
@@ -0,0 +1,70 @@
+"""Per-request identity map: during a request, each row is represented by a single Model instance.
+
+The instances built by Model.get_by_id, select and the relation properties are kept on flask.g, so the same row is only
+fetched once per request (the session's user, the current account, the inviter of an invitation...). Updates and
+deletions made through the models are applied to the mapped instances, to keep them coherent with the database.
+Rows changed with raw SQL, or by another process, are only seen by the next requests.
+
+Outside of an app context (background threads, scripts without app context) nothing is mapped."""
+from flask import g, has_app_context
+
+# Total number of fetches avoided by the identity maps of all the requests, for debugging and benchmarks
+avoided_fetch_count = 0
+
+
+class IdentityMap:
+    def __init__(self):
+        self.instances = {}  # {(db_file_name, table_name): {id: instance}}
+        self.avoided_fetch_count = 0  # Number of get_by_id served by the identity map during the request
+
+
+def current():
+    """Return the identity map of the current request, or None outside of an app context"""
+    if not has_app_context():
+        return None
+    if "identity_map" not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+
+def instances(model):
+    """Return the {id: instance} of model mapped during the current request, or None outside of an app context.
+    Lets a whole result set be mapped without looking up the request's identity map for each row."""
+    identity_map = current()
+    if identity_map is None:
+        return None
+    return identity_map.instances.setdefault((str(model.db_file_name), model.table_name), {})
+
+
+def lookup(model, id):
+    """Return the instance of the row id of model built during this request, if any"""
+    mapped = instances(model)
+    if mapped is None:
+        return None
+    return mapped.get(id)
+
+
+def get(model, id):
+    """Like lookup, for a fetch of the row that can be skipped when it's mapped: counts the avoided fetches"""
+    global avoided_fetch_count
+
+    instance = lookup(model, id)
+    if instance is not None:
+        current().avoided_fetch_count += 1
+        avoided_fetch_count += 1
+    return instance
+
+
+def update(model, id, fields):
+    """Set the new values of the fields of the row id of model on its mapped instance, if any"""
+    instance = lookup(model, id)
+    if instance is not None:
+        for field, value in fields.items():
+            setattr(instance, field, value)
+
+
+def discard(model, id):
+    """Forget the mapped instance of the row id of model: it was deleted, or changed with raw SQL"""
+    mapped = instances(model)
+    if mapped is not None:
+        mapped.pop(id, None)
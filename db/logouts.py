@@ -0,0 +1,67 @@
+"""Logout times of the users, shared by all the worker processes, so that a logout revokes the signed sessions issued
+before it, and the sessions cached before it, in every process at once (see User.get_by_signed_session and
+User.get_by_session_secret).
+
+They're kept in the DATA_DIR/logouts.db database, apart from auth.db: signed sessions are meant to avoid reading it.
+Each thread keeps a copy of the recent logouts, read again only when another connection wrote to the database, which
+SQLite tells with PRAGMA data_version without reading anything. Logouts older than both SIGNED_SESSION_TTL and
+CACHE_TTL are deleted: the signed sessions issued, and the sessions cached, before them have expired anyway."""
+import threading
+from time import time
+
+from flask import current_app
+
+from db.cache import caches
+from db.connection import connect_to_db
+
+
+class LogoutStore:
+    def __init__(self):
+        self._thread_local = threading.local()
+        self._generation = 0  # Incremented by clear(), so that the threads open their connection again
+
+    def _state(self):
+        """Return the (connection, data_version, {user_id: logout_time}) state of the current thread"""
+        state = self._thread_local
+        db_file_name = current_app.config["DATA_DIR"] / "logouts.db"
+        if getattr(state, "generation", None) != self._generation or state.db_file_name != db_file_name:
+            if getattr(state, "connection", None) is not None:
+                state.connection.close()
+            state.generation, state.db_file_name = self._generation, db_file_name
+            state.connection = connect_to_db(db_file_name)
+            with state.connection as con:
+                con.execute("PRAGMA journal_mode = WAL")
+                con.execute("CREATE TABLE IF NOT EXISTS logout (user_id INTEGER PRIMARY KEY, logged_out REAL NOT NULL)")
+            state.data_version = None
+            state.logouts = {}
+        return state
+
+    def record(self, user_id, logout_time):
+        """Revoke the signed sessions of user_id issued before logout_time"""
+        con = self._state().connection
+        with con:
+            con.execute("INSERT OR REPLACE INTO logout (user_id, logged_out) VALUES (?, ?)", (user_id, logout_time))
+            con.execute("DELETE FROM logout WHERE logged_out < ?", (time() - self.retention(),))
+        # data_version only tells the writes of the other connections
+        self._state().logouts[user_id] = logout_time
+
+    def retention(self):
+        """Return the number of seconds during which a logout is remembered"""
+        return max(current_app.config["SIGNED_SESSION_TTL"], current_app.config["CACHE_TTL"])
+
+    def last_logout(self, user_id):
+        """Return the time user_id last logged out, if during the last retention() seconds, or None"""
+        state = self._state()
+        (data_version,) = state.connection.execute("PRAGMA data_version").fetchone()
+        if data_version != state.data_version:
+            state.logouts = dict(state.connection.execute("SELECT user_id, logged_out FROM logout"))
+            state.data_version = data_version
+        return state.logouts.get(user_id)
+
+    def clear(self):
+        """Forget the connections of all the threads, e.g. between tests"""
+        self._generation += 1
+
+
+logouts = LogoutStore()
+caches.append(logouts)
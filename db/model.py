@@ -1,60 +1,351 @@
+import functools
 import sqlite3
+from types import MappingProxyType
 
-from db.connection import connect_to_db
+from db import identity_map, write_behind
+from db.connection import get_connection, in_transaction, transaction, uncached_in_transaction
 
+# Maximum number of values in the "IN (...)" of the queries of Model.prefetch, below SQLite's variables limit
+PREFETCH_CHUNK_SIZE = 500
+# Number of rows fetched at a time by Model.stream
+STREAM_CHUNK_SIZE = 500
+# Shared value of Model._prefetched for the instances without prefetched relations, to save a dict per instance
+NOT_PREFETCHED = MappingProxyType({})
 
-class Model:
+
+class Relation:
+    """Relation from the instances of a model to the rows of another model (see Model.relations): the rows of model
+    whose field is the key attribute of the instance. many=False for a single related row (or None)."""
+
+    def __init__(self, model, field, key="id", many=True):
+        self.model = model
+        self.field = field
+        self.key = key
+        self.many = many
+
+    def load(self, name, instances):
+        """Load the related rows of all the instances with one query (per PREFETCH_CHUNK_SIZE keys),
+        and store them as the value of their name property"""
+        keys = list({getattr(instance, self.key) for instance in instances} - {None})
+        related = {}
+        con = self.model.connect_to_db()
+        for start in range(0, len(keys), PREFETCH_CHUNK_SIZE):
+            chunk = keys[start : start + PREFETCH_CHUNK_SIZE]
+            with con:
+                cur = con.execute(
+                    f"SELECT {self.model.comma_separated_fields()} FROM {self.model.table_name} "
+                    f"WHERE {self.model.table_name}.{self.field} IN ({', '.join('?' for _ in chunk)})",
+                    chunk,
+                )
+            rows = cur.fetchall()
+            for row, related_instance in zip(rows, self.model.from_rows(rows)):
+                if self.many:
+                    related.setdefault(row[self.field], []).append(related_instance)
+                else:
+                    related[row[self.field]] = related_instance
+
+        for instance in instances:
+            value = related.get(getattr(instance, self.key))
+            if instance._prefetched is NOT_PREFETCHED:
+                instance._prefetched = {}
+            instance._prefetched[name] = (value or []) if self.many else value
+
+
+class Stream:
+    """Iterator over the instances of a query, fetching chunk_size rows at a time, to use in a with statement that
+    closes its cursor (see Model.stream)"""
+
+    def __init__(self, model, sql, parameters, chunk_size):
+        self.model = model
+        self.sql = sql
+        self.parameters = parameters
+        self.chunk_size = chunk_size
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = self.model.connect_to_db().execute(self.sql, self.parameters)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.close()
+        self.cursor = None
+
+    def __iter__(self):
+        if self.cursor is None:
+            raise Exception("Streams must be iterated in a with statement: with Model.stream(...) as instances: ...")
+        while True:
+            rows = self.cursor.fetchmany(self.chunk_size)
+            if not rows:
+                return
+            # Not kept in the identity map, so that memory doesn't grow with the number of rows
+            yield from self.model.from_rows(rows, register=False)
+
+
+def prefetchable(method):
+    """Decorator of the relation properties: once loaded by Model.prefetch, the relation is read from the instance
+    instead of the database"""
+
+    @property
+    @functools.wraps(method)
+    def wrapper(self):
+        try:
+            return self._prefetched[method.__name__]
+        except KeyError:
+            return method(self)
+
+    return wrapper
+
+
+class ModelMeta(type):
+    """Metaclass of the models, preparing each model class once, when it's created: its instances get __slots__ for
+    the fields instead of a __dict__ (smaller and faster to build), and it gets its own cache of SQL statements"""
+
+    def __new__(mcs, name, bases, namespace):
+        if "__slots__" not in namespace:
+            inherited_slots = {slot for base in bases for cls in base.__mro__ for slot in getattr(cls, "__slots__", ())}
+            namespace["__slots__"] = tuple(
+                field for field in namespace.get("fields", ()) if field not in inherited_slots
+            )
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._sql_cache = {}  # {(statement, columns): SQL}, see sql()
+        cls._comma_separated_fields = ", ".join(".".join((cls.table_name, field)) for field in cls.fields)
+        cls._field_setters = tuple(getattr(cls, field).__set__ for field in cls.fields)  # Slot descriptors' setters
+        cls._id_index = cls.fields.index("id") if "id" in cls.fields else None
+        return cls
+
+
+class Model(metaclass=ModelMeta):
     """Base class for all models. This class is not supposed to be instantiated directly.
     Inherit from this class and override the fields and table_name class attributes."""
 
+    # {relation name: related instance(s)}, see prefetch(). The slots of the fields are added by ModelMeta.
+    __slots__ = ("_prefetched",)
     fields = []  # Override with your fields' names
     table_name = ""  # Override with your table's name
     db_file_name = None  # Override with the name of the database file
     id = None  # Need to have a unique instance identifier called "id"
+    cache = None  # Set to a TTLCache to keep the rows read by get_by_id in memory, by id, as tuples of values
 
     def __init__(self, **kwargs):
         for field in self.fields:
             setattr(self, field, kwargs.pop(field))
         if kwargs:
             raise TypeError(f"Unexpected arguments: {', '.join(kwargs.keys())}")
+        self._prefetched = NOT_PREFETCHED
+        self.apply_pending_updates()
+
+    def apply_pending_updates(self):
+        """Set the values from update_later() that are not written to the database yet"""
+        pending = write_behind.buffer.pending(type(self), self.id)
+        if pending:
+            for field, value in pending.items():
+                setattr(self, field, value)
+
+    @classmethod
+    def from_rows(cls, rows, register=True):
+        """Return the instances of the rows, each of them being the values of the fields in the order of fields (a tuple,
+        or a sqlite3.Row selecting comma_separated_fields() first): the ones already built during the request if any
+        (see db.identity_map), or new ones, built without going through keyword arguments.
+        The new instances are added to the identity map, unless register is False."""
+        mapped = identity_map.instances(cls)
+        instances = []
+        for values in rows:
+            instance = mapped.get(values[cls._id_index]) if mapped is not None else None
+            if instance is None:
+                instance = cls.__new__(cls)
+                for set_field, value in zip(cls._field_setters, values):
+                    set_field(instance, value)
+                instance._prefetched = NOT_PREFETCHED
+                instance.apply_pending_updates()
+                if register and mapped is not None:
+                    mapped[instance.id] = instance
+            instances.append(instance)
+        return instances
+
+    @classmethod
+    def from_values(cls, values):
+        """Like from_rows, for a single row"""
+        return cls.from_rows((values,))[0]
+
+    @classmethod
+    def relations(cls):
+        """Override to return the {name: Relation} that prefetch() can load. Each name is the name of the
+        @prefetchable property returning the same related instances from the database."""
+        return {}
 
     @classmethod
-    def comma_separated_fields(self):
-        return ", ".join(".".join((self.table_name, field)) for field in self.fields)
+    def prefetch(cls, instances, *lookups):
+        """Load the relations of all the instances with one query per relation, instead of one query per instance
+        and relation when the properties are read in a loop. Nested relations are separated by "__":
+        Account.prefetch(accounts, "user_account_set__user") loads the user accounts of all the accounts, then the
+        users of all these user accounts. Returns the instances, as a list."""
+        instances = list(instances)
+        for lookup in lookups:
+            name, _, nested_lookup = lookup.partition("__")
+            relation = cls.relations()[name]
+            if not all(name in instance._prefetched for instance in instances):
+                relation.load(name, instances)
+            if nested_lookup:
+                related_instances = []
+                for instance in instances:
+                    value = instance._prefetched[name]
+                    if relation.many:
+                        related_instances.extend(value)
+                    elif value is not None:
+                        related_instances.append(value)
+                relation.model.prefetch(related_instances, nested_lookup)
+        return instances
+
+    @classmethod
+    def comma_separated_fields(cls):
+        return cls._comma_separated_fields
+
+    @classmethod
+    def sql(cls, statement, columns=()):
+        """Return the SQL of statement ("select", "count", "insert", "update" or "delete") on the model's table,
+        for these columns: filtered by select, count and delete, set by insert and update (of a row by id).
+        Each SQL string is built once per model and columns."""
+        key = (statement, columns)
+        try:
+            return cls._sql_cache[key]
+        except KeyError:
+            pass
+
+        where = f" WHERE {' AND '.join(f'{column} = ?' for column in columns)}" if columns else ""
+        if statement == "select":
+            sql = f"SELECT {cls.comma_separated_fields()} FROM {cls.table_name}{where}"
+        elif statement == "count":
+            sql = f"SELECT COUNT(*) FROM {cls.table_name}{where}"
+        elif statement == "insert":
+            sql = f"INSERT INTO {cls.table_name} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        elif statement == "update":
+            sql = f"UPDATE {cls.table_name} SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
+        elif statement == "delete":
+            sql = f"DELETE FROM {cls.table_name}{where}"
+        else:
+            raise ValueError(f"Unknown statement {statement}")
+        cls._sql_cache[key] = sql
+        return sql
 
     @classmethod
     def connect_to_db(cls):
+        """Return the connection to the model's database shared by the current request (see get_connection)"""
         try:
-            return connect_to_db(cls.db_file_name)
+            return get_connection(cls.db_file_name)
         except sqlite3.OperationalError:
             raise Exception("Database not found. Please run migrate.py to create the database first.")
 
+    @classmethod
+    def transaction(cls):
+        """Return a unit of work that the queries of all the models join, see db.connection.transaction:
+
+            with User.transaction():
+                ..."""
+        return transaction()
+
     @classmethod
     def insert(cls, **fields):
+        con = cls.connect_to_db()
+        with con:
+            cur = con.execute(cls.sql("insert", tuple(fields)), tuple(fields.values()))
+        return cur.lastrowid
+
+    @classmethod
+    def insert_many(cls, rows):
+        """Insert the rows, dicts of the same fields, with a single statement in one transaction. Returns the number of
+        rows inserted."""
+        rows = list(rows)
+        if not rows:
+            return 0
+        columns = tuple(rows[0])
+        con = cls.connect_to_db()
+        with con:
+            cur = con.executemany(cls.sql("insert", columns), (tuple(row[column] for column in columns) for row in rows))
+        return cur.rowcount
+
+    @classmethod
+    def where_clause(cls, filters):
+        """Return the (WHERE clause, parameters) matching all the {column: value} filters. Lists, tuples and sets of
+        values match any of their values. Without filters, a statement would touch the whole table: ValueError."""
+        if not filters:
+            raise ValueError(f"No filters given for {cls.table_name}")
+        conditions = []
+        parameters = []
+        for column, value in filters.items():
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(f"{column} IN ({', '.join('?' for _ in value)})")
+                parameters.extend(value)
+            else:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        return f" WHERE {' AND '.join(conditions)}", parameters
+
+    @classmethod
+    def update_where(cls, filters, **fields):
+        """Set the fields of all the rows matching the filters (see where_clause) with a single statement in one
+        transaction. Returns the number of rows updated."""
+        where, parameters = cls.where_clause(filters)
         con = cls.connect_to_db()
         with con:
             cur = con.execute(
-                f"INSERT INTO {cls.table_name} ({', '.join(fields.keys())}) VALUES ({', '.join('?' for _ in fields)})",
-                tuple(fields.values()),
+                f"UPDATE {cls.table_name} SET {', '.join(f'{field} = ?' for field in fields)}{where} RETURNING id",
+                (*fields.values(), *parameters),
             )
-        con.close()
-        return cur.lastrowid
+            ids = [id for (id,) in cur.fetchall()]
+        for id in ids:
+            write_behind.buffer.discard(cls, id, fields)
+            cls.uncache(id)
+            identity_map.update(cls, id, fields)
+        return len(ids)
+
+    @classmethod
+    def delete_where(cls, **filters):
+        """Delete all the rows matching the filters (see where_clause) with a single statement in one transaction.
+        Returns the number of rows deleted."""
+        where, parameters = cls.where_clause(filters)
+        con = cls.connect_to_db()
+        with con:
+            cur = con.execute(f"DELETE FROM {cls.table_name}{where} RETURNING id", parameters)
+            ids = [id for (id,) in cur.fetchall()]
+        for id in ids:
+            cls.uncache(id)
+            identity_map.discard(cls, id)
+        return len(ids)
 
     @classmethod
     def select(cls, **kwargs):
         con = cls.connect_to_db()
         with con:
-            if kwargs:
-                cur = con.execute(
-                    f"SELECT {cls.comma_separated_fields()} FROM {cls.table_name} WHERE {' AND '.join(f'{key} = ?' for key in kwargs.keys())}",
-                    tuple(kwargs.values()),
-                )
-            else:
-                cur = con.execute(f"SELECT {cls.comma_separated_fields()} FROM {cls.table_name}")
+            cur = con.execute(cls.sql("select", tuple(kwargs)), tuple(kwargs.values()))
 
-        rows = cur.fetchall()
-        con.close()
-        return [cls(**row) for row in rows]
+        return cls.from_rows(cur.fetchall())
+
+    @classmethod
+    def stream(cls, order_by="id", after=None, limit=None, chunk_size=STREAM_CHUNK_SIZE, **filters):
+        """Return a Stream of the instances matching the filters (see where_clause), read chunk_size rows at a time,
+        so that memory doesn't grow with the number of rows:
+
+            with User.stream(email=None, after=last_id, limit=100) as users:
+                for user in users:
+                    ...
+
+        Rows are sorted by the order_by column, descending if it starts with "-". With after, only the rows after
+        this value of the order_by column are read: a page starts after the last row of the previous page, which
+        doesn't get slower with the page number like an OFFSET would (order_by must be unique)."""
+        descending = order_by.startswith("-")
+        order_by = order_by.lstrip("-")
+        if order_by not in cls.fields:
+            raise ValueError(f"Unknown field {order_by}")
+        where, parameters = cls.where_clause(filters) if filters else ("", [])  # Reading them all is fine
+        if after is not None:
+            where += f"{' AND' if where else ' WHERE'} {order_by} {'<' if descending else '>'} ?"
+            parameters.append(after)
+        sql = f"SELECT {cls.comma_separated_fields()} FROM {cls.table_name}{where} "
+        sql += f"ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return Stream(cls, sql, parameters, chunk_size)
 
     @classmethod
     def select_one(cls, **kwargs):
@@ -67,64 +358,86 @@ class Model:
     def count(cls, **kwargs):
         con = cls.connect_to_db()
         with con:
-            if kwargs:
-                cur = con.execute(
-                    f"SELECT COUNT(*) FROM {cls.table_name} WHERE {' AND '.join(f'{key} = ?' for key in kwargs.keys())}",
-                    tuple(kwargs.values()),
-                )
-            else:
-                cur = con.execute(f"SELECT COUNT(*) FROM {cls.table_name}")
+            cur = con.execute(cls.sql("count", tuple(kwargs)), tuple(kwargs.values()))
 
         row = cur.fetchone()
-        con.close()
         return row[0]
 
     @classmethod
     def get_by_id(cls, id):
+        instance = identity_map.get(cls, id)
+        if instance is not None:
+            return instance
+
+        if cls.cache is not None:
+            values = cls.cache.get(id)
+            if values is not None:
+                return cls.from_values(values)
+
         con = cls.connect_to_db()
         with con:
-            cur = con.execute(
-                f"SELECT {cls.comma_separated_fields()} FROM {cls.table_name} WHERE id = ?",
-                (id,),
-            )
+            cur = con.execute(cls.sql("select", ("id",)), (id,))
         row = cur.fetchone()
-        con.close()
         if row is None:
             return None
-        return cls(**row)
+        cls.cache_values(id, tuple(row))
+        return cls.from_values(row)
 
     @classmethod
     def update_by_id(cls, id, **fields):
+        write_behind.buffer.discard(cls, id, fields)
         con = cls.connect_to_db()
         with con:
-            cur = con.execute(
-                f"""UPDATE {cls.table_name} SET {', '.join(f'{key} = ?' for key in fields.keys())} WHERE id = ?""",
-                (*fields.values(), id),
-            )
-        con.close()
+            cur = con.execute(cls.sql("update", tuple(fields)), (*fields.values(), id))
+        cls.uncache(id)
+        identity_map.update(cls, id, fields)
         return cur.rowcount == 1
 
     @classmethod
     def delete_by_id(cls, id):
         con = cls.connect_to_db()
         with con:
-            cur = con.execute(f"DELETE FROM {cls.table_name} WHERE id = ?", (id,))
-        con.close()
+            cur = con.execute(cls.sql("delete", ("id",)), (id,))
+        cls.uncache(id)
+        identity_map.discard(cls, id)
         return cur.rowcount == 1
 
+    @classmethod
+    def cache_values(cls, id, values):
+        """Cache the values of the row id, unless they're read in a unit of work, which could still be rolled back"""
+        if cls.cache is not None and not in_transaction():
+            cls.cache.set(id, values)
+
+    @classmethod
+    def uncache(cls, id):
+        """Forget the cached row of this id, if any. Called after each write to the row."""
+        if cls.cache is not None:
+            cls.cache.pop(id)
+            uncached_in_transaction(cls, id)
+
     def update(self, **fields):
+        write_behind.buffer.discard(type(self), self.id, fields)
         con = self.connect_to_db()
         with con:
-            cur = con.execute(
-                f"""UPDATE {self.table_name} SET {', '.join(f'{key} = ?' for key in fields.keys())} WHERE id = ?""",
-                (*fields.values(), self.id),
-            )
-        con.close()
+            cur = con.execute(self.sql("update", tuple(fields)), (*fields.values(), self.id))
+        self.uncache(self.id)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        identity_map.update(type(self), self.id, fields)
         return cur.rowcount == 1
 
+    def update_later(self, **fields):
+        """Like update, for values that can be written a bit later, or even lost: they're written with other updates
+        in a single transaction, see db.write_behind"""
+        write_behind.buffer.update(type(self), self.id, **fields)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        identity_map.update(type(self), self.id, fields)
+
     def delete(self):
         con = self.connect_to_db()
         with con:
-            cur = con.execute(f"DELETE FROM {self.table_name} WHERE id = ?", (self.id,))
-        con.close()
+            cur = con.execute(self.sql("delete", ("id",)), (self.id,))
+        self.uncache(self.id)
+        identity_map.discard(type(self), self.id)
         return cur.rowcount == 1
@@ -3,8 +3,10 @@ from pathlib import Path
 
 from flask import current_app
 
+from db.cache import TTLCache
+from db.model import Relation, prefetchable
 from db.models.auth.auth_model import AuthModel
-from migrate import build_migrations_list, migrate
+from migrate import create_db_from_template, get_migrations, schema_version
 
 
 class Account(AuthModel):
@@ -13,9 +15,22 @@ class Account(AuthModel):
         "id",
         "account_db_file_name",  # account_db_file_name is the name of the database file for auth
         "name",
+        "schema_version",  # Sequence number of the last accounts migration applied to the account database
     )
+    # Accounts by id: each request reads the current account of the user
+    cache = TTLCache(current_app.config["CACHE_SIZE"], current_app.config["CACHE_TTL"])
 
-    @property
+    @classmethod
+    def relations(cls):
+        from db.models.auth.invitation import Invitation
+        from db.models.auth.user_account import UserAccount
+
+        return {
+            "user_account_set": Relation(UserAccount, "account_id"),
+            "invitation_set": Relation(Invitation, "account_id"),
+        }
+
+    @prefetchable
     def user_account_set(self):
         """Return a set of user accounts that belong to this account."""
         from db.models.auth.user_account import UserAccount
@@ -28,7 +43,7 @@ class Account(AuthModel):
                     WHERE user_account.account_id = ?""",
                 (self.id,),
             )
-        return [UserAccount(**row) for row in cur.fetchall()]
+        return UserAccount.from_rows(cur.fetchall())
 
     @property
     def user_set(self):
@@ -44,7 +59,7 @@ class Account(AuthModel):
                     WHERE user_account.account_id = ?""",
                 (self.id,),
             )
-        return [User(**row) for row in cur.fetchall()]
+        return User.from_rows(cur.fetchall())
 
     @property
     def current_user_set(self):
@@ -59,9 +74,9 @@ class Account(AuthModel):
                     WHERE user.current_account_id = ?""",
                 (self.id,),
             )
-        return [User(**row) for row in cur.fetchall()]
+        return User.from_rows(cur.fetchall())
 
-    @property
+    @prefetchable
     def invitation_set(self):
         """Return a set of invitations that belong to this account."""
         from db.models.auth.invitation import Invitation
@@ -74,13 +89,12 @@ class Account(AuthModel):
                     WHERE invitation.account_id = ?""",
                 (self.id,),
             )
-        return [Invitation(**row) for row in cur.fetchall()]
+        return Invitation.from_rows(cur.fetchall())
 
     @classmethod
     def create_db(cls, db_file_name):
-        """Create the database for this account."""
-        migrations = build_migrations_list("accounts")
-        migrate(db_file_name, migrations)
+        """Create the database for this account, as a copy of the fully migrated accounts template database."""
+        create_db_from_template(db_file_name, "accounts", current_app.config["DATA_DIR"])
 
     @classmethod
     def insert(cls, name):
@@ -92,11 +106,11 @@ class Account(AuthModel):
         con = cls.connect_to_db()
         with con:
             cur = con.execute(
-                f"INSERT INTO {cls.table_name} (name, account_db_file_name) VALUES (?, ?)",
-                (name, account_db_file_name.as_posix()),
+                f"INSERT INTO {cls.table_name} (name, account_db_file_name, schema_version) VALUES (?, ?, ?)",
+                # The account database is a copy of the template, which has all the migrations applied
+                (name, account_db_file_name.as_posix(), schema_version(get_migrations("accounts"))),
             )
             account_id = cur.lastrowid
-        con.close()
 
         # Create the account database
         Account.create_db(account_db_file_name)
@@ -110,13 +124,15 @@ class Account(AuthModel):
             con.execute(
                 "INSERT INTO user_account (account_id, user_id, role) VALUES (?, ?, ?)", (self.id, user.id, role)
             )
-        con.close()
 
     def role(self, user_id):
         """Returns the role of the user in the account, or None if the user is not in the account."""
         from db.models.auth.user_account import UserAccount
 
-        user_account = UserAccount.select(user_id=user_id, account_id=self.id)
+        if "user_account_set" in self._prefetched:
+            user_account = [user_account for user_account in self.user_account_set if user_account.user_id == user_id]
+        else:
+            user_account = UserAccount.select(user_id=user_id, account_id=self.id)
         if user_account:
             return user_account[0].role
         return None
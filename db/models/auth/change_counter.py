@@ -0,0 +1,25 @@
+from db.models.auth.auth_model import AuthModel
+
+
+class ChangeCounter(AuthModel):
+    """Version of the data of a user or an account, incremented by the triggers of the 00005_change_counters migration.
+    The primary key is (scope, id): get_by_id and the other methods by id don't apply."""
+
+    table_name = "change_counter"
+    fields = ("scope", "id", "version")
+    SCOPE_USER = "user"
+    SCOPE_ACCOUNT = "account"
+
+    @classmethod
+    def versions_of_user(cls, user_id):
+        """Return the ((scope, id, version), ...) of the user and of all its accounts, with a single query"""
+        con = cls.connect_to_db()
+        with con:
+            cur = con.execute(
+                f"""SELECT scope, id, version FROM {cls.table_name}
+                    WHERE (scope = ? AND id = ?)
+                       OR (scope = ? AND id IN (SELECT account_id FROM user_account WHERE user_id = ?))
+                    ORDER BY scope, id""",
+                (cls.SCOPE_USER, user_id, cls.SCOPE_ACCOUNT, user_id),
+            )
+            return tuple(tuple(row) for row in cur.fetchall())
@@ -40,6 +40,35 @@ class Invitation(AuthModel):
             fields["secret"] = cls.generate_secret()
         return super().insert(**fields)
 
+    @classmethod
+    def insert_many(cls, rows):
+        # Generate a secret for each invitation without one
+        return super().insert_many({"secret": cls.generate_secret(), **row} for row in rows)
+
+    @classmethod
+    def insert_for_emails(cls, account_id, emails, role, created_by):
+        """Invite all the emails to join the account, in one transaction. Returns ({email: result}, invitations), where
+        result is "invited", "already invited" or "invalid", and invitations are the new invitations."""
+        results = {}
+        for email in emails:
+            email = email.strip()
+            if email and email not in results:
+                results[email] = "invited" if "@" in email else "invalid"
+        new_emails = [email for email, result in results.items() if result == "invited"]
+        if not new_emails:
+            return results, []
+
+        with cls.transaction():
+            for invitation in cls.select(account_id=account_id):
+                if invitation.email in results:
+                    results[invitation.email] = "already invited"
+            new_emails = [email for email in new_emails if results[email] == "invited"]
+            cls.insert_many(
+                dict(account_id=account_id, email=email, created_by=created_by, role=role) for email in new_emails
+            )
+            with cls.stream(account_id=account_id, email=new_emails) as invitations:
+                return results, list(invitations)
+
     @classmethod
     def get_by_secret(cls, secret):
         for invitation in cls.select(secret=secret):
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+
+from db import identity_map
+from db.models.auth.auth_model import AuthModel
+
+# Seconds after which an email claimed by a worker is claimed again, if the worker died before delivering it
+CLAIM_DURATION = 300
+
+
+def utc_timestamp(delay=0):
+    """UTC time in delay seconds, in the format of SQLite's current_timestamp"""
+    return (datetime.now(timezone.utc) + timedelta(seconds=delay)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class OutboxEmail(AuthModel):
+    table_name = "email_outbox"
+    fields = (
+        "id",
+        "to_email",
+        "subject",
+        "html_content",
+        "status",
+        "attempts",  # Number of delivery attempts, including the current one
+        "next_attempt",
+        "last_error",
+        "created",
+        "sent",
+    )
+    STATUS_PENDING = "pending"
+    STATUS_SENT = "sent"
+    STATUS_FAILED = "failed"
+
+    @classmethod
+    def claim_due(cls, limit):
+        """Claim at most limit pending emails whose next attempt is due, counting this attempt. The other workers
+        don't claim them for CLAIM_DURATION seconds, while this one delivers them."""
+        con = cls.connect_to_db()
+        with con:
+            cur = con.execute(
+                f"""UPDATE {cls.table_name}
+                    SET attempts = attempts + 1, next_attempt = ?
+                    WHERE id IN (
+                        SELECT id FROM {cls.table_name}
+                        WHERE status = ? AND next_attempt <= ?
+                        ORDER BY next_attempt
+                        LIMIT ?
+                    )
+                    RETURNING {', '.join(cls.fields)}""",
+                (utc_timestamp(CLAIM_DURATION), cls.STATUS_PENDING, utc_timestamp(), limit),
+            )
+            rows = cur.fetchall()
+        # The instances of these emails mapped by a previous claim are stale
+        for row in rows:
+            identity_map.discard(cls, row["id"])
+        return cls.from_rows(rows)
+
+    def mark_sent(self):
+        self.update(status=self.STATUS_SENT, sent=utc_timestamp(), last_error=None)
+
+    def mark_failed(self, error, max_attempts, retry_delay):
+        """Retry the email in retry_delay seconds, doubled after each attempt, or give up after max_attempts"""
+        if self.attempts >= max_attempts:
+            self.update(status=self.STATUS_FAILED, last_error=error)
+        else:
+            self.update(next_attempt=utc_timestamp(retry_delay * 2 ** (self.attempts - 1)), last_error=error)
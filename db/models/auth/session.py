@@ -26,7 +26,6 @@ class Session(AuthModel):
                     expires,
                 ),
             )
-        con.close()
         return cur.lastrowid
 
     @classmethod
@@ -40,10 +39,17 @@ class Session(AuthModel):
                 (secret, datetime.now()),
             )
         row = cur.fetchone()
-        con.close()
         if row is None:
             return None
-        return cls(**row)
+        return cls.from_values(row)
+
+    def update(self, **fields):
+        from db.models.auth.user import User
+
+        result = super().update(**fields)
+        # The session may not belong to the same user anymore
+        User.session_cache.pop(self.secret)
+        return result
 
     @property
     def user(self):
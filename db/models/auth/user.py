@@ -1,15 +1,29 @@
 import secrets
 from datetime import datetime
+from time import time
 
 from flask import current_app, session, g
-from werkzeug.security import generate_password_hash, check_password_hash
 
+from db.cache import TTLCache
+from db.connection import in_transaction
+from db.logouts import logouts
+from db.model import Relation, prefetchable
 from db.models.auth.auth_model import AuthModel
+from passwords import hasher
 
 
 class User(AuthModel):
     table_name = "user"
     fields = ("id", "name", "email", "password_hash", "created", "last_login", "current_account_id")
+    # Users by id, and user ids by session secret: authenticated requests usually don't have to read auth.db
+    cache = TTLCache(current_app.config["CACHE_SIZE"], current_app.config["CACHE_TTL"])
+    session_cache = TTLCache(current_app.config["CACHE_SIZE"], current_app.config["CACHE_TTL"])
+
+    @classmethod
+    def relations(cls):
+        from db.models.auth.user_account import UserAccount
+
+        return {"user_account_set": Relation(UserAccount, "user_id")}
 
     @property
     def current_account(self):
@@ -19,9 +33,8 @@ class User(AuthModel):
 
     @classmethod
     def generate_password_hash(cls, password):
-        # Tests run slow with default hash algorithm PBKDF2
-        # We're using scrypt here so that tests run faster, and our app is still secure (compared to sha256)
-        return generate_password_hash(password, method="scrypt")
+        # Computed by the password hashing processes, with the PASSWORD_HASH_METHOD of the config (scrypt by default)
+        return hasher.generate(password)
 
     @classmethod
     def insert(cls, name, email, password):
@@ -34,42 +47,95 @@ class User(AuthModel):
         else:
             password_hash = cls.generate_password_hash(password)
 
-        # Create a default personal account for the user
-        account_id = Account.insert("Personal")
+        # The user, its personal account and its membership are committed at once
+        with cls.transaction():
+            # Create a default personal account for the user
+            account_id = Account.insert("Personal")
 
-        with con:
-            cur = con.execute(
-                f'INSERT INTO {cls.table_name} ("name", "email", "password_hash", "current_account_id") VALUES (?, ?, ?, ?)',
-                (
-                    name,
-                    email,
-                    password_hash,
-                    account_id,
-                ),
-            )
-            user_id = cur.lastrowid
-        con.close()
+            with con:
+                cur = con.execute(
+                    f'INSERT INTO {cls.table_name} ("name", "email", "password_hash", "current_account_id") VALUES (?, ?, ?, ?)',
+                    (
+                        name,
+                        email,
+                        password_hash,
+                        account_id,
+                    ),
+                )
+                user_id = cur.lastrowid
 
-        # Link the user to the default personal account
-        UserAccount.insert(user_id=user_id, account_id=account_id, role="admin")
+            # Link the user to the default personal account
+            UserAccount.insert(user_id=user_id, account_id=account_id, role="admin")
         return user_id
 
     @classmethod
     def get_by_session_secret(cls, secret):
+        user_id = cls.session_cache.get(secret)
+        # Logged out in another worker process since it was cached, maybe: check the session table again
+        if user_id is not None and logouts.last_logout(user_id) is None:
+            user = cls.get_by_id(user_id)
+            if user is not None:
+                return user
+
+        now = datetime.now()
         con = cls.connect_to_db()
         with con:
             cur = con.execute(
-                f"""SELECT {cls.comma_separated_fields()}
+                f"""SELECT {cls.comma_separated_fields()}, session.expires
                     FROM user 
                     INNER JOIN session ON session.user_id = user.id
                     WHERE session.secret = ? AND session.expires > ?""",
-                (secret, datetime.now()),
+                (secret, now),
             )
         row = cur.fetchone()
-        con.close()
         if row is None:
             return None
-        return cls(**row)
+        values = tuple(row)[: len(cls.fields)]
+        if not in_transaction():
+            # Don't keep the session in cache after it expires
+            cls.session_cache.set(secret, row["id"], ttl=(datetime.fromisoformat(row["expires"]) - now).total_seconds())
+        cls.cache_values(row["id"], values)
+        return cls.from_values(values)
+
+    @classmethod
+    def get_by_signed_session(cls):
+        """Return the user of the signed session of the Flask session cookie, without reading the session table,
+        if it was issued less than SIGNED_SESSION_TTL seconds ago and the user didn't log out since. None otherwise."""
+        signed_session = session.get(current_app.config["SIGNED_SESSION_KEY"])
+        if not signed_session or time() - signed_session["issued_at"] > current_app.config["SIGNED_SESSION_TTL"]:
+            return None
+
+        # Logged out in any worker process since then
+        logout_time = logouts.last_logout(signed_session["user_id"])
+        if logout_time is not None and logout_time >= signed_session["issued_at"]:
+            return None
+
+        user = cls.get_by_id(signed_session["user_id"])
+        if user is None or user.current_account_id != signed_session["account_id"]:
+            return None
+        return user
+
+    @classmethod
+    def get_by_session_secret_and_sign(cls, secret):
+        """Check the session secret against the session table, like get_by_session_secret, and store a new signed
+        session in the Flask session cookie so that the next requests can trust it (see get_by_signed_session)"""
+        from db.models.auth.session import Session
+
+        SIGNED_SESSION_KEY = current_app.config["SIGNED_SESSION_KEY"]
+
+        db_session = Session.select_one_unexpired(secret)
+        user = db_session.user if db_session else None
+        if user is None:
+            session.pop(SIGNED_SESSION_KEY, None)
+            return None
+
+        session[SIGNED_SESSION_KEY] = {
+            "user_id": user.id,
+            "account_id": user.current_account_id,
+            "session_id": db_session.id,
+            "issued_at": time(),
+        }
+        return user
 
     @classmethod
     def login(cls, email, password):
@@ -82,9 +148,14 @@ class User(AuthModel):
         if user is None:
             return None, False
 
-        if check_password_hash(user.password_hash, password):
+        if hasher.check(user.password_hash, password):
+            if hasher.needs_rehash(user.password_hash):
+                # Upgrade the hash to the current PASSWORD_HASH_METHOD, now that the password is known
+                user.update(password_hash=hasher.generate(password))
+
             # Update the db session to point to the logged-in user, but only if it's a guest session!
-            db_session = Session.select_one_unexpired(secret=session[SESSION_SECRET_KEY])
+            secret = session.get(SESSION_SECRET_KEY)
+            db_session = Session.select_one_unexpired(secret=secret) if secret else None
             if db_session:
                 if db_session.user.email is None:
                     # Update the guest session to point to the logged-in user
@@ -98,11 +169,17 @@ class User(AuthModel):
                     g.user = user
                     g.account = user.current_account
             else:
-                # Low chance of happening because we create guest session by default
-                Session.insert(user_id=user.id)
+                # Visitor without session: no guest is created for the login requests
+                db_session = Session.get_by_id(Session.insert(user_id=user.id))
+                session[SESSION_SECRET_KEY] = db_session.secret
+                g.user = user
+                g.account = user.current_account
+
+            # The signed session, if any, was issued for the previous user
+            session.pop(current_app.config["SIGNED_SESSION_KEY"], None)
 
             # Update the last login time
-            user.update(last_login=datetime.now())
+            user.update_later(last_login=datetime.now())
 
             return user, True
         return user, False
@@ -123,8 +200,10 @@ class User(AuthModel):
                     now,
                 ),
             )
-        con.close()
+        self.session_cache.pop_values(self.id)
+        logouts.record(self.id, time())
         session.pop(SESSION_SECRET_KEY, None)
+        session.pop(current_app.config["SIGNED_SESSION_KEY"], None)
 
     @property
     def account_set(self):
@@ -135,40 +214,61 @@ class User(AuthModel):
             cur = con.execute(
                 f"SELECT {Account.comma_separated_fields()} FROM user_account "
                 f"INNER JOIN account ON account.id = user_account.account_id "
-                f"WHERE user_account.user_id = ?",
+                f"WHERE user_account.user_id = ? "
+                f"ORDER BY user_account.id",
                 (self.id,),
             )
-            for row in cur.fetchall():
-                yield Account(**row)
-        con.close()
+        return Account.from_rows(cur.fetchall())
 
-    @property
+    @prefetchable
     def user_account_set(self):
         from db.models.auth.user_account import UserAccount
 
         con = self.connect_to_db()
         with con:
             cur = con.execute(
-                f"SELECT {UserAccount.comma_separated_fields()} FROM user_account WHERE user_account.user_id = ?",
+                f"SELECT {UserAccount.comma_separated_fields()} FROM user_account WHERE user_account.user_id = ? "
+                f"ORDER BY user_account.id",
                 (self.id,),
             )
-            for row in cur.fetchall():
-                yield UserAccount(**row)
-        con.close()
+        return UserAccount.from_rows(cur.fetchall())
 
     @property
     def zip_account_set(self):
+        # Both sets are sorted by user account
         return zip(self.account_set, self.user_account_set)
 
     @classmethod
     def create_guest_and_login(cls):
         from db.models.auth.session import Session
 
-        user_id = cls.insert(name="Guest", email=None, password=None)
+        with cls.transaction():
+            user_id = cls.insert(name="Guest", email=None, password=None)
+            db_session_id = Session.insert(user_id)
+            db_session = Session.get_by_id(db_session_id)
+            user = User.get_by_id(user_id)
 
         SESSION_SECRET_KEY = current_app.config["SESSION_SECRET_KEY"]
-        db_session_id = Session.insert(user_id)
-        db_session = Session.get_by_id(db_session_id)
-        user = User.get_by_id(user_id)
         session[SESSION_SECRET_KEY] = db_session.secret
         return user
+
+
+class GuestUser:
+    """In-memory stand-in for a visitor without a valid session. Nothing is stored in the database for them:
+    the actual guest user, its account and its database file are created by User.create_guest_and_login()
+    when they sign up (see create_guest_session_if_needed)."""
+
+    id = None
+    name = "Guest"
+    email = None
+    password_hash = None
+    current_account_id = None
+    current_account = None
+    account_set = ()
+    user_account_set = ()
+    zip_account_set = ()
+
+    def logout(self):
+        """Nothing to expire in the database, just forget the session secret, if any."""
+        session.pop(current_app.config["SESSION_SECRET_KEY"], None)
+        session.pop(current_app.config["SIGNED_SESSION_KEY"], None)
@@ -1,3 +1,4 @@
+from db.model import Relation, prefetchable
 from db.models.auth.auth_model import AuthModel
 
 
@@ -5,7 +6,13 @@ class UserAccount(AuthModel):
     table_name = "user_account"
     fields = ("id", "user_id", "account_id", "role")
 
-    @property
+    @classmethod
+    def relations(cls):
+        from db.models.auth.user import User
+
+        return {"user": Relation(User, "id", key="user_id", many=False)}
+
+    @prefetchable
     def user(self):
         from db.models.auth.user import User
 
@@ -22,6 +29,5 @@ class UserAccount(AuthModel):
                     WHERE account_id != ? AND user_id = ?""",
                 (exclude_account_id, user_id),
             )
-        result = [cls(**row) for row in cur.fetchall()]
-        con.close()
+        result = cls.from_rows(cur.fetchall())
         return result
@@ -0,0 +1,143 @@
+"""Write-behind buffer for the non-critical updates made on most requests (last login time, current account...).
+
+Instead of one write transaction, and one fsync, per update, Model.update_later() keeps the new values in memory,
+merging the updates of the same row. A background thread writes them all in a single transaction per database every
+flush_interval seconds, as soon as max_size rows are pending, and when the process exits normally.
+
+Crash safety: the pending updates are lost if the process crashes or is killed before they're flushed, that is at most
+flush_interval seconds or max_size rows of updates. Only use it for values that can be lost, never for data entered by
+the user. Until they're flushed, the pending values are only seen by the models built in the current process."""
+import atexit
+import sqlite3
+import threading
+import traceback
+from collections import defaultdict
+
+from db.connection import connect_to_db
+
+
+class WriteBehindBuffer:
+    def __init__(self, flush_interval=1.0, max_size=1000):
+        self.flush_interval = flush_interval  # In seconds. 0 writes updates immediately.
+        self.max_size = max_size
+        self.update_count = 0  # Number of updates received
+        self.write_count = 0  # Number of rows actually written
+        self.flush_count = 0  # Number of flushes, each of them being one transaction per database
+        self._pending = {}  # {(model, id): {field: value}}
+        self._flushing = {}  # Updates being written by flush(), still to be seen by pending()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._thread = None
+
+    def configure(self, flush_interval, max_size):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+
+    def update(self, model, id, **fields):
+        """Update the fields of the row id of model later"""
+        if self.flush_interval <= 0:
+            model.update_by_id(id, **fields)
+            return
+
+        with self._lock:
+            self._pending.setdefault((model, id), {}).update(fields)
+            self.update_count += 1
+            pending_count = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        if pending_count >= self.max_size:
+            self._flush_requested.set()
+
+    def pending(self, model, id):
+        """Return the {field: value} not written yet for the row id of model, if any"""
+        flushing = self._flushing.get((model, id))
+        pending = self._pending.get((model, id))
+        if flushing and pending:
+            return {**flushing, **pending}
+        return pending or flushing
+
+    def discard(self, model, id, fields):
+        """Forget the pending updates of these fields: they're about to be written by a synchronous update"""
+        with self._lock:
+            pending = self._pending.get((model, id))
+            if pending:
+                for field in fields:
+                    pending.pop(field, None)
+                if not pending:
+                    del self._pending[(model, id)]
+            flushing = (model, id) in self._flushing
+        if flushing:
+            # Wait for the flush writing older values of the row, so that the synchronous update is written after it
+            with self._flush_lock:
+                pass
+
+    def flush(self):
+        """Write all the pending updates, in one transaction per database. Returns the number of rows updated."""
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+            if not self._flushing:
+                return 0
+
+            # {db_file_name: {(table name, fields): [(value, ..., id), ...]}}
+            statements = defaultdict(lambda: defaultdict(list))
+            for (model, id), fields in self._flushing.items():
+                statements[model.db_file_name][(model.table_name, tuple(fields))].append((*fields.values(), id))
+
+            write_count = 0
+            for db_file_name, db_statements in statements.items():
+                write_count += self._write(db_file_name, db_statements)
+            written, self._flushing = self._flushing, {}
+            # The cached rows were read before the updates
+            for model, id in written:
+                model.uncache(id)
+            self.write_count += write_count
+            self.flush_count += 1
+            return write_count
+
+    @staticmethod
+    def _write(db_file_name, db_statements):
+        con = connect_to_db(db_file_name)
+        try:
+            try:
+                with con:
+                    for (table_name, fields), parameters in db_statements.items():
+                        con.executemany(
+                            f"UPDATE {table_name} SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                            parameters,
+                        )
+                return sum(len(parameters) for parameters in db_statements.values())
+            except sqlite3.Error:
+                pass
+
+            # Some update is invalid (e.g. it references a deleted row): write the other ones one by one
+            write_count = 0
+            for (table_name, fields), parameters in db_statements.items():
+                for row_parameters in parameters:
+                    try:
+                        with con:
+                            con.execute(
+                                f"UPDATE {table_name} SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                                row_parameters,
+                            )
+                        write_count += 1
+                    except sqlite3.Error as exception:
+                        print(f"Dropping update of {table_name} {row_parameters[-1]}: {exception}")
+            return write_count
+        finally:
+            con.close()
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+buffer = WriteBehindBuffer()
@@ -0,0 +1,272 @@
+import argparse
+import pathlib
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+
+from flask import current_app
+
+import app
+from db.connection import connect_to_db
+
+
+def reap_sessions(db_file_name, grace_period, batch_size=500, pause=0.1):
+    """Delete the sessions expired for more than grace_period, batch_size rows at a time, pausing pause seconds between
+    batches so that the requests never wait long for the write lock. Returns (deleted sessions count, seconds spent)."""
+    start_time = perf_counter()
+    expired_before = datetime.now() - grace_period
+    deleted_count = 0
+
+    con = connect_to_db(db_file_name)
+    while True:
+        with con:
+            cur = con.execute(
+                "DELETE FROM session WHERE id IN (SELECT id FROM session WHERE expires < ? LIMIT ?)",
+                (expired_before, batch_size),
+            )
+        deleted_count += cur.rowcount
+        if cur.rowcount < batch_size:
+            break
+        sleep(pause)
+    con.close()
+
+    return deleted_count, perf_counter() - start_time
+
+
+def purge_emails(db_file_name, older_than, batch_size=500, pause=0.1):
+    """Delete the emails of the outbox sent, or given up, more than older_than ago: their bodies contain secrets (password
+    reset links, invitations). Works batch_size rows per transaction, pausing pause seconds between batches.
+    Returns (deleted emails count, seconds spent)."""
+    from db.models.auth.outbox_email import OutboxEmail, utc_timestamp
+
+    start_time = perf_counter()
+    before = utc_timestamp(-older_than.total_seconds())
+    deleted_count = 0
+
+    con = connect_to_db(db_file_name)
+    while True:
+        with con:
+            cur = con.execute(
+                """DELETE FROM email_outbox WHERE id IN (
+                       SELECT id FROM email_outbox
+                       WHERE (status = ? AND sent < ?) OR (status = ? AND next_attempt < ?)
+                       LIMIT ?
+                   )""",
+                (OutboxEmail.STATUS_SENT, before, OutboxEmail.STATUS_FAILED, before, batch_size),
+            )
+        deleted_count += cur.rowcount
+        if cur.rowcount < batch_size:
+            break
+        sleep(pause)
+    con.close()
+
+    return deleted_count, perf_counter() - start_time
+
+
+def removable_directories(file_names, root):
+    """Return the directories under root that would be empty once file_names are removed, deepest first"""
+    removed = set(file_names)
+    directories = {parent for file_name in file_names for parent in file_name.parents if root in parent.parents}
+    empty_directories = []
+    for directory in sorted(directories, key=lambda directory: len(directory.parts), reverse=True):
+        if all(child in removed for child in directory.iterdir()):
+            removed.add(directory)
+            empty_directories.append(directory)
+    return empty_directories
+
+
+def collect_guests(db_file_name, data_dir, older_than, batch_size=100, pause=0.1, dry_run=False):
+    """Delete the guest users (without email) created more than older_than ago and without any unexpired session,
+    with the accounts only they belong to, the accounts' database files and the shard directories left empty.
+    Works batch_size users per transaction, pausing pause seconds between batches.
+    With dry_run, nothing is deleted. Returns the {"users", "accounts", "files", "directories", "bytes"} counts."""
+    start_time = perf_counter()
+    counts = dict(users=0, accounts=0, files=0, directories=0, bytes=0)
+    accounts_dir = (pathlib.Path(data_dir) / "accounts").resolve()
+    # user.created is in UTC (SQLite's current_timestamp), session.expires in local time (datetime.now())
+    created_before = (datetime.now(timezone.utc) - older_than).strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.now()
+
+    con = connect_to_db(db_file_name)
+    last_user_id = 0
+    while True:
+        user_ids = [
+            user_id
+            for (user_id,) in con.execute(
+                """SELECT user.id FROM user
+                   WHERE user.id > ? AND user.email IS NULL AND user.created < ?
+                   AND NOT EXISTS (SELECT 1 FROM session WHERE session.user_id = user.id AND session.expires > ?)
+                   ORDER BY user.id
+                   LIMIT ?""",
+                (last_user_id, created_before, now, batch_size),
+            )
+        ]
+        if not user_ids:
+            break
+        last_user_id = user_ids[-1]
+
+        user_ids_placeholders = ", ".join("?" for _ in user_ids)
+        # Accounts that no other user belongs to
+        accounts = list(
+            con.execute(
+                f"""SELECT DISTINCT account.id, account.account_db_file_name FROM account
+                    INNER JOIN user_account ON user_account.account_id = account.id
+                    WHERE user_account.user_id IN ({user_ids_placeholders})
+                    AND NOT EXISTS (
+                        SELECT 1 FROM user_account AS member
+                        WHERE member.account_id = account.id AND member.user_id NOT IN ({user_ids_placeholders})
+                    )""",
+                (*user_ids, *user_ids),
+            )
+        )
+        file_names = [
+            file_name
+            for _, account_db_file_name in accounts
+            for suffix in ("", "-wal", "-shm")
+            if (file_name := pathlib.Path(account_db_file_name + suffix)).exists()
+        ]
+        directories = removable_directories(file_names, accounts_dir)
+
+        counts["users"] += len(user_ids)
+        counts["accounts"] += len(accounts)
+        counts["files"] += len(file_names)
+        counts["directories"] += len(directories)
+        counts["bytes"] += sum(file_name.stat().st_size for file_name in file_names)
+        if dry_run:
+            continue
+
+        # Deleting the users and accounts also deletes their sessions, memberships and invitations
+        with con:
+            account_ids = [account_id for account_id, _ in accounts]
+            con.execute(f"DELETE FROM account WHERE id IN ({', '.join('?' for _ in account_ids)})", account_ids)
+            con.execute(f"DELETE FROM user WHERE id IN ({user_ids_placeholders})", user_ids)
+        for file_name in file_names:
+            file_name.unlink(missing_ok=True)
+        for directory in directories:
+            directory.rmdir()
+        sleep(pause)
+    con.close()
+
+    counts["seconds"] = perf_counter() - start_time
+    return counts
+
+
+def start_session_reaper(flask_app):
+    """Reap the expired sessions every SESSION_REAPER_INTERVAL seconds, in a background thread"""
+    from db.models.auth.auth_model import AuthModel
+
+    config = flask_app.config
+
+    def run_reaper():
+        while True:
+            sleep(config["SESSION_REAPER_INTERVAL"])
+            try:
+                deleted_count, elapsed = reap_sessions(
+                    AuthModel.db_file_name, config["SESSION_REAPER_GRACE_PERIOD"], config["SESSION_REAPER_BATCH_SIZE"]
+                )
+                if deleted_count:
+                    print(f"Session reaper: deleted {deleted_count} expired sessions in {elapsed:.3f} seconds.")
+            except Exception:
+                traceback.print_exc()
+
+    threading.Thread(target=run_reaper, name="session-reaper", daemon=True).start()
+
+
+def run_reap_sessions(args):
+    from db.models.auth.auth_model import AuthModel
+
+    config = current_app.config
+    deleted_count, elapsed = reap_sessions(
+        AuthModel.db_file_name,
+        config["SESSION_REAPER_GRACE_PERIOD"] if args.grace_days is None else timedelta(days=args.grace_days),
+        config["SESSION_REAPER_BATCH_SIZE"] if args.batch_size is None else args.batch_size,
+    )
+    print(f"Deleted {deleted_count} expired sessions in {elapsed:.3f} seconds.")
+
+
+def run_collect_guests(args):
+    from db.models.auth.auth_model import AuthModel
+
+    config = current_app.config
+    counts = collect_guests(
+        AuthModel.db_file_name,
+        config["DATA_DIR"],
+        config["GUEST_GC_AGE"] if args.days is None else timedelta(days=args.days),
+        dry_run=args.dry_run,
+    )
+    print(
+        f"{'Would delete' if args.dry_run else 'Deleted'} {counts['users']} guest users and {counts['accounts']} "
+        f"accounts, reclaiming {counts['bytes']} bytes and {counts['files'] + counts['directories']} inodes "
+        f"({counts['files']} files, {counts['directories']} directories) in {counts['seconds']:.3f} seconds."
+    )
+
+
+def run_deliver_emails(args):
+    from blueprints.email import outbox_worker
+
+    flask_app = current_app._get_current_object()
+    if args.once:
+        print(f"Delivered {outbox_worker.deliver(flask_app)} emails.")
+    else:
+        outbox_worker.run(flask_app)
+
+
+def run_purge_emails(args):
+    from db.models.auth.auth_model import AuthModel
+
+    deleted_count, elapsed = purge_emails(
+        AuthModel.db_file_name,
+        current_app.config["EMAIL_OUTBOX_RETENTION"] if args.days is None else timedelta(days=args.days),
+    )
+    print(f"Deleted {deleted_count} sent or failed emails in {elapsed:.3f} seconds.")
+
+
+def run_rate_limit_stats(args):
+    from ratelimit import SQLiteBuckets
+
+    config = current_app.config
+    if config["RATE_LIMIT_BACKEND"] != "sqlite":
+        print("Only the sqlite backend of the rate limiter keeps the counts of all the processes.")
+        return
+    buckets = SQLiteBuckets(config["RATE_LIMIT_DB_FILE"] or config["DATA_DIR"] / "rate_limits.db")
+    for key_type, counts in sorted(buckets.stats().items()):
+        allowed, limited = counts.get("allowed", 0), counts.get("limited", 0)
+        print(f"Per {key_type}: {allowed} requests allowed, {limited} limited ({limited / (allowed + limited):.1%}).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance jobs of the auth database.")
+    subparsers = parser.add_subparsers(required=True)
+
+    reap_sessions_parser = subparsers.add_parser("reap-sessions", help="Delete the sessions expired for a while")
+    reap_sessions_parser.add_argument("--grace-days", type=float, help="Only delete sessions expired for longer")
+    reap_sessions_parser.add_argument("--batch-size", type=int, help="Number of sessions deleted per transaction")
+    reap_sessions_parser.set_defaults(run=run_reap_sessions)
+
+    collect_guests_parser = subparsers.add_parser(
+        "gc-guests", help="Delete the abandoned guest users, with their accounts and database files"
+    )
+    collect_guests_parser.add_argument("--days", type=float, help="Only delete guests created more than days ago")
+    collect_guests_parser.add_argument("--dry-run", action="store_true", help="Only report what would be deleted")
+    collect_guests_parser.set_defaults(run=run_collect_guests)
+
+    deliver_emails_parser = subparsers.add_parser("deliver-emails", help="Deliver the emails of the outbox")
+    deliver_emails_parser.add_argument("--once", action="store_true", help="Exit once no email is due")
+    deliver_emails_parser.set_defaults(run=run_deliver_emails)
+
+    purge_emails_parser = subparsers.add_parser(
+        "purge-emails", help="Delete the emails of the outbox sent or given up for a while"
+    )
+    purge_emails_parser.add_argument("--days", type=float, help="Only delete emails sent or given up longer ago")
+    purge_emails_parser.set_defaults(run=run_purge_emails)
+
+    rate_limit_stats_parser = subparsers.add_parser(
+        "rate-limit-stats", help="Count the requests allowed and limited by the rate limiter, to size its buckets"
+    )
+    rate_limit_stats_parser.set_defaults(run=run_rate_limit_stats)
+
+    args = parser.parse_args()
+    # The jobs don't send emails, and deliver-emails delivers them itself
+    with app.create_app({"EMAIL_WORKER": False}).app_context():
+        args.run(args)
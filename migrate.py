@@ -1,26 +1,71 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import os
 import pathlib
+import shutil
 import sqlite3
+import sys
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from operator import itemgetter
 from time import perf_counter
 
+from flask import current_app, has_app_context
+
 import app
 from db.connection import connect_to_db
 
 
+# A migration file, with its position in the migrations list and the hash of its content
+Migration = namedtuple("Migration", ("sequence", "name", "code", "checksum"))
+
+# Migrations are read from disk once per process: {subpath: (Migration, ...)}
+_migrations_registry = {}
+
+
 def build_migrations_list(subpath):
     migrations = []
     migration_path = pathlib.Path("migrations") / subpath
 
     for file in migration_path.iterdir():
+        if not file.name.endswith(".sql"):
+            continue  # Not a SQL file: skip this one
         with file.open("r") as f:
             migrations.append((file.name, f.read()))
 
     # Sort migrations by alphabetical order: 00001_..., 00002_..., etc.
     migrations.sort(key=itemgetter(0))
-    return migrations
+    return tuple(
+        Migration(sequence, name, code, hashlib.sha256(code.encode()).hexdigest())
+        for sequence, (name, code) in enumerate(migrations, start=1)
+    )
+
+
+def get_migrations(subpath):
+    """Return the migrations of subpath, only reading them from disk the first time"""
+    if subpath not in _migrations_registry:
+        _migrations_registry[subpath] = build_migrations_list(subpath)
+    return _migrations_registry[subpath]
+
+
+def schema_version(migrations):
+    """Return the sequence number of the last migration: a database with all migrations applied is at this version"""
+    return migrations[-1].sequence if migrations else 0
+
+
+def configured_journal_mode():
+    """Return the journal_mode of config.ini's sqlite section, if any"""
+    if has_app_context():
+        return current_app.config["SQLITE_PRAGMAS"].get("journal_mode")
+    return None
 
 
-def migrate(db_file_name, migrations):
+def migrate(db_file_name, migrations, journal_mode=None):
+    """Apply the missing migrations to the db_file_name database, and return its schema version.
+    The journal_mode (config.ini's one by default) is persistent: it's stored in the database file itself."""
     db_file_path = pathlib.Path(db_file_name).parent
 
     # Let's create the DB directory, if it doesn't already exist
@@ -28,72 +73,231 @@ def migrate(db_file_name, migrations):
 
     migrate_con = sqlite3.connect(db_file_name)
     migrate_cur = migrate_con.cursor()
-    print(f"Creating table migrations on the {db_file_name} database, if not already there.")
-    migrate_cur.execute("CREATE TABLE IF NOT EXISTS migration(name TEXT NOT NULL UNIQUE)")
 
-    applied_migrations = set()
-    for (migration_name,) in migrate_cur.execute("SELECT name FROM migration ORDER BY name"):
-        applied_migrations.add(migration_name)
+    journal_mode = journal_mode or configured_journal_mode()
+    if journal_mode:
+        (current_journal_mode,) = migrate_cur.execute("PRAGMA journal_mode").fetchone()
+        if current_journal_mode.lower() != journal_mode.lower():
+            print(f"Setting journal mode {journal_mode} on the {db_file_name} database.")
+            migrate_cur.execute(f"PRAGMA journal_mode = {journal_mode}")
 
-    for migration_name, migration_code in migrations:
-        if not migration_name.endswith(".sql"):
-            continue  # Not a SQL file: skip this one
+    print(f"Creating table migrations on the {db_file_name} database, if not already there.")
+    migrate_cur.execute("CREATE TABLE IF NOT EXISTS migration(name TEXT NOT NULL UNIQUE, checksum TEXT NULL)")
+    if "checksum" not in [column[1] for column in migrate_cur.execute("PRAGMA table_info(migration)")]:
+        # Databases migrated before checksums were introduced
+        migrate_cur.execute("ALTER TABLE migration ADD COLUMN checksum TEXT NULL")
 
-        if migration_name in applied_migrations:
-            continue  # Already applied: skip this one
+    applied_migrations = dict(migrate_cur.execute("SELECT name, checksum FROM migration ORDER BY name"))
+
+    for migration in migrations:
+        if migration.name in applied_migrations:
+            # Already applied: skip this one, but make sure it wasn't edited since
+            applied_checksum = applied_migrations[migration.name]
+            if applied_checksum is None:
+                migrate_cur.execute("UPDATE migration SET checksum = ? WHERE name = ?", (migration.checksum, migration.name))
+                migrate_con.commit()
+            elif applied_checksum != migration.checksum:
+                migrate_con.close()
+                raise Exception(
+                    f"Migration {migration.name} was modified after being applied to the {db_file_name} database. "
+                    "Don't edit applied migrations: create a new one instead."
+                )
+            continue
 
         try:
-            migrate_cur.executescript(migration_code)
+            migrate_cur.executescript(migration.code)
         except:
             print("Error while applying migration:")
-            print(migration_code)
+            print(migration.code)
             raise
 
         start_time = perf_counter()
-        print(f"Applying migration {migration_name} to {db_file_name} database...")
-        migrate_cur.execute("INSERT INTO migration VALUES(?)", (migration_name,))
+        print(f"Applying migration {migration.name} to {db_file_name} database...")
+        migrate_cur.execute("INSERT INTO migration (name, checksum) VALUES (?, ?)", (migration.name, migration.checksum))
         migrate_con.commit()
         print("Done in {:.6f} seconds".format(perf_counter() - start_time))
     migrate_con.close()
+    return schema_version(migrations)
+
+
+def migrations_checksum(migrations):
+    """Return a hash identifying this exact list of migrations: it changes as soon as a migration is added or edited"""
+    checksum = hashlib.sha256()
+    for migration in migrations:
+        checksum.update(migration.name.encode())
+        checksum.update(migration.checksum.encode())
+    return checksum.hexdigest()
+
+
+def build_template_db(subpath, data_dir):
+    """Return the path of a database with all the migrations of subpath applied, building it if needed.
+    New databases are copies of this template, which is much faster than replaying all the migrations."""
+    migrations = get_migrations(subpath)
+    template_dir = pathlib.Path(data_dir) / "templates"
+    template_db_file_name = template_dir / f"{subpath}_{migrations_checksum(migrations)[:16]}.db"
+    if template_db_file_name.exists():
+        return template_db_file_name
+
+    # Build into a temporary file first, so that no one ever copies a half-migrated template
+    template_dir.mkdir(parents=True, exist_ok=True)
+    fd, temporary_db_file_name = tempfile.mkstemp(".tmp", f"{template_db_file_name.name}.", template_dir)
+    os.close(fd)
+    try:
+        migrate(temporary_db_file_name, migrations)
+        os.replace(temporary_db_file_name, template_db_file_name)
+    except BaseException:
+        os.unlink(temporary_db_file_name)
+        raise
+    return template_db_file_name
+
 
+def delete_outdated_templates(subpath, data_dir):
+    """Delete the templates of subpath built before the current one, for previous versions of the migrations.
+    The ones built since, by processes still running other migrations during a deployment, are kept."""
+    template_db_file_name = build_template_db(subpath, data_dir)
+    built = template_db_file_name.stat().st_mtime
+    for outdated_template in template_db_file_name.parent.glob(f"{subpath}_*.db"):
+        with contextlib.suppress(FileNotFoundError):
+            if outdated_template != template_db_file_name and outdated_template.stat().st_mtime < built:
+                outdated_template.unlink()
 
-def migrate_account(account_id, migrations):
-    from db.models.auth.account import Account
 
-    account = Account.get_by_id(account_id)
-    print(f"Migrating account {account.id} in {account.account_db_file_name} file...")
+def create_db_from_template(db_file_name, subpath, data_dir):
+    """Create the db_file_name database as a copy of the fully migrated template database of subpath"""
+    template_db_file_name = build_template_db(subpath, data_dir)
+    pathlib.Path(db_file_name).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(template_db_file_name, db_file_name)
 
-    migrate(account.account_db_file_name, migrations)
 
+def migrate_account(account_id, account_db_file_name, migrations, quiet=False, journal_mode=None):
+    """Apply the missing migrations to an account database. Returns (account_id, error message or None) instead of
+    raising, so that a broken account doesn't prevent the other ones from being migrated."""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+            print(f"Migrating account {account_id} in {account_db_file_name} file...")
+            migrate(account_db_file_name, migrations, journal_mode=journal_mode)
+    except Exception as exception:
+        return account_id, f"{type(exception).__name__}: {exception}"
+    return account_id, None
 
-def run():
+
+# Migrations and journal mode of the worker processes of migrate_accounts, sent once per process by init_worker
+_worker_settings = None
+
+
+def init_worker(migrations, journal_mode):
+    global _worker_settings
+    _worker_settings = migrations, journal_mode
+
+
+def migrate_account_in_worker(account_id, account_db_file_name):
+    migrations, journal_mode = _worker_settings
+    return migrate_account(account_id, account_db_file_name, migrations, quiet=True, journal_mode=journal_mode)
+
+
+def print_progress(done_count, account_count, failure_count, start_time):
+    elapsed = perf_counter() - start_time
+    print(
+        f"\rMigrated {done_count}/{account_count} accounts, {failure_count} failed "
+        f"({done_count / elapsed if elapsed else 0:.1f} accounts/s)",
+        end="" if done_count < account_count else "\n",
+        flush=True,
+    )
+
+
+def migrate_accounts(accounts, migrations, jobs=1):
+    """Migrate the (account_id, account_db_file_name) accounts, in jobs parallel processes if jobs > 1.
+    Returns {account_id: error message} for the accounts that failed."""
+    failures = {}
+    # The worker processes don't have access to the app's config
+    journal_mode = configured_journal_mode()
+    start_time = perf_counter()
+
+    if jobs <= 1:
+        for account_id, account_db_file_name in accounts:
+            _, error = migrate_account(account_id, account_db_file_name, migrations)
+            if error:
+                print(f"Error while migrating account {account_id}: {error}")
+                failures[account_id] = error
+        return failures
+
+    # The migrations are sent to each worker process once, rather than with each account
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(migrations, journal_mode)) as executor:
+        futures = {
+            executor.submit(migrate_account_in_worker, account_id, account_db_file_name): account_id
+            for account_id, account_db_file_name in accounts
+        }
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            try:
+                account_id, error = future.result()
+            except Exception as exception:  # The worker process died
+                account_id, error = futures[future], f"{type(exception).__name__}: {exception}"
+            if error:
+                failures[account_id] = error
+            print_progress(done_count, len(futures), len(failures), start_time)
+    return failures
+
+
+def run(jobs=1, all_accounts=False):
+    """Apply the missing migrations to the auth database, then to the databases of the accounts that are behind
+    (or to all of them with all_accounts, to check them all). Returns {account_id: error message} for the accounts
+    that failed."""
     from db.models.auth.auth_model import AuthModel
 
     # Auth database contains the list of all customer accounts' db files in the "account" table
     print("Running missing migrations on the auth database.")
 
     # Run auth module migrations first
-    migrate(AuthModel.db_file_name, build_migrations_list("auth"))
+    migrate(AuthModel.db_file_name, get_migrations("auth"))
+
+    migrations = get_migrations("accounts")
+
+    # Build the template for the new accounts now, rather than during the first signup, and delete the previous ones
+    delete_outdated_templates("accounts", current_app.config["DATA_DIR"])
 
+    latest_schema_version = schema_version(migrations)
     con = connect_to_db(AuthModel.db_file_name)
     with con:
-        cur = con.execute("SELECT COUNT(*) FROM account")
-    (account_count,) = cur.fetchone()
-    print(f"Migrating {account_count} accounts.")
+        cur = con.execute(
+            "SELECT id, account_db_file_name FROM account WHERE schema_version < ? ORDER BY id",
+            (latest_schema_version + 1 if all_accounts else latest_schema_version,),
+        )
+        accounts = [tuple(row) for row in cur]
+    con.close()  # Close here to prevent locking the database file during account migrations
 
-    migrations = build_migrations_list("accounts")
+    if not accounts:
+        print("No account to migrate.")
+        return {}
 
-    account_ids = list(cur.execute("SELECT id FROM account ORDER BY id"))
-    con.close()  # Close here to prevent locking the database file during account migrations
+    print(f"Migrating {len(accounts)} accounts{f' with {jobs} processes' if jobs > 1 else ''}.")
+    start_time = perf_counter()
+    failures = migrate_accounts(accounts, migrations, jobs=jobs)
+    elapsed = perf_counter() - start_time
+    print(f"Done: {len(accounts)} accounts in {elapsed:.3f} seconds ({len(accounts) / elapsed:.1f} accounts/s).")
 
-    for (account_id,) in account_ids:
-        migrate_account(account_id, migrations=migrations)
-    else:
-        print("No account.")
+    # Remember which accounts are up-to-date, so that the next run doesn't even open their database file
+    con = connect_to_db(AuthModel.db_file_name)
+    with con:
+        con.executemany(
+            "UPDATE account SET schema_version = ? WHERE id = ?",
+            [(latest_schema_version, account_id) for account_id, _ in accounts if account_id not in failures],
+        )
+    con.close()
 
-    print("Done.")
+    if failures:
+        print(f"{len(failures)} accounts failed to migrate:")
+        for account_id, error in sorted(failures.items()):
+            print(f"  account {account_id}: {error}")
+    return failures
 
 
 if __name__ == "__main__":
-    with app.create_app().app_context():
-        run()
+    parser = argparse.ArgumentParser(description="Apply the missing migrations to the auth and accounts databases.")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes migrating the accounts in parallel")
+    parser.add_argument("--all", action="store_true", help="Check all the accounts, even the up-to-date ones")
+    args = parser.parse_args()
+
+    # No email worker: the email_outbox table may not exist yet
+    with app.create_app({"EMAIL_WORKER": False}).app_context():
+        failures = run(jobs=args.jobs, all_accounts=args.all)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,5 @@
+-- Sequence number of the last accounts migration applied to the account's database file.
+-- Kept up to date by migrate.py, so that it only opens the databases of the accounts that are behind.
+ALTER TABLE account ADD COLUMN schema_version INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS account_schema_version ON account (schema_version);
@@ -0,0 +1,8 @@
+-- Indexes on the columns filtered on every request: sessions of a user (logout), members, current users and
+-- invitations of an account. They also keep the foreign keys' ON DELETE actions from scanning the child tables.
+CREATE INDEX IF NOT EXISTS session_user_id_expires ON session (user_id, expires);
+CREATE INDEX IF NOT EXISTS session_expires ON session (expires);
+CREATE INDEX IF NOT EXISTS user_account_account_id_role ON user_account (account_id, role);
+CREATE INDEX IF NOT EXISTS user_current_account_id ON user (current_account_id);
+CREATE INDEX IF NOT EXISTS invitation_account_id ON invitation (account_id);
+CREATE INDEX IF NOT EXISTS invitation_created_by ON invitation (created_by);
@@ -0,0 +1,16 @@
+-- Emails waiting to be delivered by the outbox worker (see blueprints.email), so that requests never wait for the
+-- email provider. next_attempt is in UTC, like current_timestamp.
+CREATE TABLE IF NOT EXISTS email_outbox
+(
+    id           INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    to_email     TEXT                              NOT NULL,
+    subject      TEXT                              NOT NULL,
+    html_content TEXT                              NOT NULL,
+    status       TEXT                              NOT NULL default 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts     INTEGER                           NOT NULL default 0,
+    next_attempt TEXT                              NOT NULL default current_timestamp, -- It's a datetime
+    last_error   TEXT,
+    created      TEXT                              NOT NULL default current_timestamp, -- It's a datetime
+    sent         TEXT                                                                  -- It's a datetime
+);
+CREATE INDEX IF NOT EXISTS email_outbox_status_next_attempt ON email_outbox (status, next_attempt);
@@ -0,0 +1,73 @@
+-- Version of the data displayed to each user, and of each account, incremented on every change by the triggers below.
+-- Pages built from them answer conditional GETs with 304 without building anything (see blueprints.conditional).
+-- Triggers rather than the models, so that raw SQL, bulk writes and the foreign keys' ON DELETE actions count too.
+CREATE TABLE IF NOT EXISTS change_counter
+(
+    scope   TEXT    NOT NULL CHECK (scope IN ('user', 'account')),
+    id      INTEGER NOT NULL, -- Id of the user or account
+    version INTEGER NOT NULL,
+    PRIMARY KEY (scope, id)
+) WITHOUT ROWID;
+
+-- Users: their name and email are displayed on the pages of their accounts. Not on last_login or password changes.
+CREATE TRIGGER IF NOT EXISTS user_update_change_counter
+    AFTER UPDATE OF name, email, current_account_id ON user
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('user', NEW.id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO change_counter (scope, id, version)
+    SELECT 'account', account_id, 1 FROM user_account WHERE user_id = NEW.id
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+-- Accounts
+CREATE TRIGGER IF NOT EXISTS account_update_change_counter AFTER UPDATE ON account
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('account', NEW.id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS account_delete_change_counter AFTER DELETE ON account
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('account', OLD.id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+-- Members: the accounts of the user, and the members of the account
+CREATE TRIGGER IF NOT EXISTS user_account_insert_change_counter AFTER INSERT ON user_account
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('user', NEW.user_id, 1), ('account', NEW.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_account_update_change_counter AFTER UPDATE ON user_account
+BEGIN
+    INSERT INTO change_counter (scope, id, version)
+    VALUES ('user', OLD.user_id, 1), ('account', OLD.account_id, 1), ('user', NEW.user_id, 1), ('account', NEW.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_account_delete_change_counter AFTER DELETE ON user_account
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('user', OLD.user_id, 1), ('account', OLD.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+-- Invitations
+CREATE TRIGGER IF NOT EXISTS invitation_insert_change_counter AFTER INSERT ON invitation
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('account', NEW.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS invitation_update_change_counter AFTER UPDATE ON invitation
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('account', OLD.account_id, 1), ('account', NEW.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS invitation_delete_change_counter AFTER DELETE ON invitation
+BEGIN
+    INSERT INTO change_counter (scope, id, version) VALUES ('account', OLD.account_id, 1)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
@@ -0,0 +1,35 @@
+-- The counters of the deleted users and accounts are deleted with them: no page displays them anymore. The ON DELETE
+-- CASCADE actions deleting their members and invitations don't create them again.
+DROP TRIGGER IF EXISTS account_delete_change_counter;
+CREATE TRIGGER IF NOT EXISTS account_delete_change_counter AFTER DELETE ON account
+BEGIN
+    DELETE FROM change_counter WHERE scope = 'account' AND id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_delete_change_counter AFTER DELETE ON user
+BEGIN
+    DELETE FROM change_counter WHERE scope = 'user' AND id = OLD.id;
+END;
+
+DROP TRIGGER IF EXISTS user_account_delete_change_counter;
+CREATE TRIGGER IF NOT EXISTS user_account_delete_change_counter AFTER DELETE ON user_account
+BEGIN
+    INSERT INTO change_counter (scope, id, version)
+    SELECT 'user', OLD.user_id, 1 WHERE EXISTS (SELECT 1 FROM user WHERE id = OLD.user_id)
+    UNION ALL
+    SELECT 'account', OLD.account_id, 1 WHERE EXISTS (SELECT 1 FROM account WHERE id = OLD.account_id)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+DROP TRIGGER IF EXISTS invitation_delete_change_counter;
+CREATE TRIGGER IF NOT EXISTS invitation_delete_change_counter AFTER DELETE ON invitation
+BEGIN
+    INSERT INTO change_counter (scope, id, version)
+    SELECT 'account', OLD.account_id, 1 WHERE EXISTS (SELECT 1 FROM account WHERE id = OLD.account_id)
+    ON CONFLICT (scope, id) DO UPDATE SET version = version + 1;
+END;
+
+-- Counters left behind by the users and accounts already deleted (guests collected by gc-guests...)
+DELETE FROM change_counter
+WHERE (scope = 'user' AND id NOT IN (SELECT id FROM user))
+   OR (scope = 'account' AND id NOT IN (SELECT id FROM account));
@@ -0,0 +1,95 @@
+"""Password hashing in a pool of worker processes.
+
+scrypt pins a CPU core for tens of milliseconds per hash: in the request thread, a burst of logins would starve all the
+other requests of the worker process. The hashes are computed by a pool of at most `workers` processes instead, while
+the request thread waits without holding the GIL. At most `max_queue` hashes wait for a free process: beyond that the
+request fails fast with 503 Service Unavailable rather than piling up. When a worker process dies, the pool is rebuilt
+and the hash computed again.
+
+With 0 workers, hashes are computed in the request thread, like before (tests, scripts).
+
+Hashes are computed with `method` ("scrypt:N:r:p", the werkzeug format, or just "scrypt" for werkzeug's defaults). The
+hashes stored with other parameters keep working, and are upgraded to the current ones by the next successful login (see
+User.login)."""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+@lru_cache
+def full_method(method):
+    """Return method with all its parameters, the way it prefixes the hashes: "scrypt" -> "scrypt:32768:8:1"."""
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = "Too many logins at the same time, please try again in a moment."
+
+
+class PasswordHasher:
+    def __init__(self, method="scrypt:32768:8:1", workers=2, max_queue=32):
+        self.method = method
+        self.workers = workers
+        self.max_queue = max_queue
+        self.busy_count = 0  # Number of hashes refused because the queue was full
+        self.broken_count = 0  # Number of times the pool was rebuilt, after one of its processes died
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+
+    def configure(self, method, workers, max_queue):
+        with self._lock:
+            if self._executor is not None and (workers, max_queue) != (self.workers, self.max_queue):
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.method = full_method(method)
+            self.workers = workers
+            self.max_queue = max_queue
+            self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def _run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            self.busy_count += 1
+            raise PasswordHasherBusy(retry_after=1)
+        try:
+            for _ in range(2):
+                with self._lock:
+                    if self._executor is None:
+                        # Not forked: the app process has threads (write-behind, email outbox...)
+                        self._executor = ProcessPoolExecutor(self.workers, multiprocessing.get_context("forkserver"))
+                    executor = self._executor
+                try:
+                    return executor.submit(function, *args).result()
+                except BrokenProcessPool:
+                    # A worker process died (killed by the OOM killer...): the pool can't be used anymore
+                    self.broken_count += 1
+                    with self._lock:
+                        if self._executor is executor:
+                            self._executor = None
+            raise PasswordHasherBusy(retry_after=1)
+        finally:
+            slots.release()
+
+    def generate(self, password):
+        """Return the hash of password, with the current method"""
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        """Return whether password matches password_hash, whatever its method"""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Return whether password_hash was computed with another method than the current one"""
+        return password_hash.split("$", 1)[0] != self.method
+
+
+hasher = PasswordHasher()
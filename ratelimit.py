@@ -0,0 +1,152 @@
+"""Token-bucket rate limiting of the expensive auth endpoints (login, signup, forgotten and reset password).
+
+Each client IP, and each email entered in the forms, has a bucket of `capacity` tokens, refilled entirely in `period`
+seconds. Each request takes a token from the buckets of its IP and email. Without tokens left, the request is answered
+429 Too Many Requests with a Retry-After header, before any password hashing or database work (see
+blueprints.auth.rate_limit_auth_endpoints).
+
+The buckets are kept in memory, per worker process, or with the "sqlite" backend in the RATE_LIMIT_DB_FILE database,
+shared by all the worker processes. The numbers of allowed and limited requests, per kind of key, are counted to size
+the buckets: limiter.stats() in the process, and `python maintenance.py rate-limit-stats` for the sqlite backend."""
+import math
+import threading
+from time import time
+
+from werkzeug.exceptions import TooManyRequests
+
+from db.connection import connect_to_db
+
+# Buckets kept by the memory backend, beyond which the least recently used ones are forgotten
+MAX_MEMORY_BUCKETS = 100000
+# The sqlite backend deletes the buckets refilled entirely once every PURGE_INTERVAL requests
+PURGE_INTERVAL = 1000
+
+
+def take_token(tokens, updated, now, capacity, period):
+    """Return (tokens, retry_after) of a bucket of tokens at time updated, after taking a token at time now.
+    retry_after is 0 when a token was taken, or else the seconds before one is available."""
+    rate = capacity / period
+    tokens = capacity if tokens is None else min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, math.ceil((1 - tokens) / rate)
+
+
+class MemoryBuckets:
+    def __init__(self):
+        self._buckets = {}  # {key: (tokens, updated)}, from the least to the most recently used
+        self._lock = threading.Lock()
+
+    def take(self, key_type, key, capacity, period):
+        """Take a token from the bucket of the key, returning 0, or else the seconds before one is available"""
+        now = time()
+        key = f"{key_type}:{key}"
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (None, now))
+            tokens, retry_after = take_token(tokens, updated, now, capacity, period)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > MAX_MEMORY_BUCKETS:
+                del self._buckets[next(iter(self._buckets))]
+        return retry_after
+
+
+class SQLiteBuckets:
+    def __init__(self, db_file_name):
+        self.db_file_name = db_file_name
+        self._thread_local = threading.local()
+        self._take_count = 0
+
+    def connection(self):
+        """Return the connection of the current thread, kept open since it's used on each limited request"""
+        con = getattr(self._thread_local, "connection", None)
+        if con is None:
+            con = self._thread_local.connection = connect_to_db(self.db_file_name)
+            con.isolation_level = None  # Transactions are begun explicitly, to take the write lock first
+            con.execute("PRAGMA journal_mode = WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            con.execute(
+                """CREATE TABLE IF NOT EXISTS rate_limit_counter
+                   (key_type TEXT, result TEXT, count INTEGER NOT NULL, PRIMARY KEY (key_type, result))"""
+            )
+        return con
+
+    def take(self, key_type, key, capacity, period):
+        """Like MemoryBuckets.take, also counting the allowed and limited requests of all the processes"""
+        con = self.connection()
+        now = time()
+        key = f"{key_type}:{key}"
+        # The other processes can't take a token from the bucket between its read and its write
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT tokens, updated FROM rate_limit_bucket WHERE key = ?", (key,)).fetchone()
+            tokens, retry_after = take_token(*(row or (None, now)), now, capacity, period)
+            con.execute(
+                "INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now)
+            )
+            con.execute(
+                """INSERT INTO rate_limit_counter (key_type, result, count) VALUES (?, ?, 1)
+                   ON CONFLICT (key_type, result) DO UPDATE SET count = count + 1""",
+                (key_type, "limited" if retry_after else "allowed"),
+            )
+            self._take_count += 1
+            if self._take_count % PURGE_INTERVAL == 0:
+                # Buckets untouched for a whole period are full again: they're the same as no bucket
+                con.execute(
+                    "DELETE FROM rate_limit_bucket WHERE key LIKE ? AND updated < ?", (f"{key_type}:%", now - period)
+                )
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        return retry_after
+
+    def stats(self):
+        """Return the {key_type: {result: count}} of all the processes"""
+        stats = {}
+        for key_type, result, count in self.connection().execute("SELECT * FROM rate_limit_counter"):
+            stats.setdefault(key_type, {})[result] = count
+        return stats
+
+
+class RateLimiter:
+    def __init__(self):
+        self.limits = {}  # {key_type: (capacity, period)}
+        self.backend = MemoryBuckets()
+        self._counts = {}  # {key_type: {"allowed": count, "limited": count}}
+        self._lock = threading.Lock()
+
+    def configure(self, backend, db_file_name, limits):
+        """Use the "memory" or "sqlite" backend (None disables the limiter), with the {key_type: (capacity, period)}
+        limits. Starts from full buckets and zero counts."""
+        if backend is None:
+            self.backend = None
+        elif backend == "memory":
+            self.backend = MemoryBuckets()
+        elif backend == "sqlite":
+            self.backend = SQLiteBuckets(db_file_name)
+        else:
+            raise Exception(f"Unknown rate limit backend {backend}")
+        self.limits = {key_type: limit for key_type, limit in limits.items() if limit}
+        self._counts = {}
+
+    def hit(self, key_type, key):
+        """Take a token from the bucket of the key, or raise TooManyRequests if it's empty"""
+        if self.backend is None or key_type not in self.limits:
+            return
+        retry_after = self.backend.take(key_type, key, *self.limits[key_type])
+        result = "limited" if retry_after else "allowed"
+        with self._lock:
+            counts = self._counts.setdefault(key_type, {"allowed": 0, "limited": 0})
+            counts[result] += 1
+        if retry_after:
+            raise TooManyRequests(retry_after=retry_after)
+
+    def stats(self):
+        """Return the {key_type: {"allowed": count, "limited": count}} of this process"""
+        with self._lock:
+            return {key_type: dict(counts) for key_type, counts in self._counts.items()}
+
+
+limiter = RateLimiter()
@@ -1,5 +1,11 @@
+import hashlib
+import os
 import shutil
+import signal
+import threading
+import time
 import unittest
+from contextlib import contextmanager
 from pathlib import Path
 from unittest.mock import patch
 
@@ -12,16 +18,54 @@ class TestCase(unittest.TestCase):
             {
                 "TESTING": True,
                 "DATA_DIR": Path("test_data"),
+                # Emails are delivered to test_data/outbox by _deliver_emails()
+                "EMAIL_TRANSPORT": "file",
+                "EMAIL_WORKER": False,
+                # Hashed in the test thread, without starting worker processes
+                "PASSWORD_HASH_WORKERS": 0,
             }
         )
         self.client = self.app.test_client()
         import migrate
 
-        migrate.run()
+        with self.app.app_context():
+            migrate.run()
 
     def tearDown(self):
+        from db.cache import clear_caches
+        from db.connection import close_connections
+        from db.write_behind import buffer
+
+        buffer.flush()
+        close_connections()
+        clear_caches()
         shutil.rmtree(self.app.config["DATA_DIR"])
 
+    def _deliver_emails(self):
+        """Deliver the emails of the outbox, and return the content of the ones delivered"""
+        from blueprints.email import outbox_worker
+
+        sink_dir = self.app.config["DATA_DIR"] / "outbox"
+        delivered_before = set(sink_dir.glob("*.html"))
+        outbox_worker.deliver(self.app)
+        return [path.read_text() for path in sorted(set(sink_dir.glob("*.html")) - delivered_before)]
+
+    @contextmanager
+    def _trace_statements(self):
+        """Collect the SQL statements run on the connections opened within the with statement into the list yielded"""
+        from db import connection
+
+        statements = []
+        connect_to_db = connection.connect_to_db
+
+        def connect_and_trace(db_file_name):
+            con = connect_to_db(db_file_name)
+            con.set_trace_callback(statements.append)
+            return con
+
+        with patch("db.connection.connect_to_db", connect_and_trace):
+            yield statements
+
     def test_integration(self):
         """Run all subtests one after the other"""
         with self.subTest("Test guest access"):
@@ -89,6 +133,775 @@ class TestCase(unittest.TestCase):
         with self.subTest("Log in with the new password"):
             self._test_login_new_password()
 
+    def test_signed_sessions(self):
+        """Signed sessions are trusted without checking the session table, until the user logs out"""
+        self.app.config["SIGNED_SESSION_TTL"] = 60
+        self.test_integration()
+
+        # Log in the same user from another browser
+        other_client = self.app.test_client()
+        other_client.post("/login", data=dict(email="invitee@localhost", password="tutu"))
+        other_client.get("/")
+        with patch("db.models.auth.session.Session.select_one_unexpired") as select_one_unexpired:
+            response = other_client.get("/")
+        select_one_unexpired.assert_not_called()
+        self.assertIn("<h1>Hi, Invitee!</h1>", response.text)
+
+        # Logging out expires the sessions of all the user's browsers
+        self.client.get("/logout")
+        response = other_client.get("/")
+        self.assertIn("<h1>Hi, Guest!</h1>", response.text)
+
+        # Logouts made by the other worker processes are shared through logouts.db
+        import sqlite3
+
+        other_client.post("/login", data=dict(email="invitee@localhost", password="tutu"))
+        self.assertIn("<h1>Hi, Invitee!</h1>", other_client.get("/").text)
+        data_dir = self.app.config["DATA_DIR"]
+        with sqlite3.connect(data_dir / "auth.db") as con:  # What User.logout does in another process
+            (user_id,) = con.execute("SELECT id FROM user WHERE email = 'invitee@localhost'").fetchone()
+            con.execute("UPDATE session SET expires = datetime('now', 'localtime') WHERE user_id = ?", (user_id,))
+        con.close()
+        with sqlite3.connect(data_dir / "logouts.db") as con:
+            con.execute("INSERT OR REPLACE INTO logout (user_id, logged_out) VALUES (?, ?)", (user_id, time.time()))
+        con.close()
+        response = other_client.get("/")
+        self.assertIn("<h1>Hi, Guest!</h1>", response.text)
+
+    def test_session_cache_logout(self):
+        """Sessions cached by a worker process aren't trusted anymore once the user logs out in another one"""
+        import sqlite3
+
+        from db.logouts import logouts
+
+        self.client.post("/signup", data=dict(name="Alice", email="alice@localhost", password="test", password2="test"))
+        self.assertIn("<h1>Hi, Alice!</h1>", self.client.get("/").text)
+        data_dir = self.app.config["DATA_DIR"]
+        with sqlite3.connect(data_dir / "auth.db") as con:  # What User.logout does in another process
+            (user_id,) = con.execute("SELECT id FROM user WHERE email = 'alice@localhost'").fetchone()
+            con.execute("UPDATE session SET expires = datetime('now', 'localtime') WHERE user_id = ?", (user_id,))
+        con.close()
+
+        def record_logout():  # With its own connection to logouts.db, like another process
+            with self.app.app_context():
+                logouts.record(user_id, time.time())
+
+        thread = threading.Thread(target=record_logout)
+        thread.start()
+        thread.join()
+        self.assertIn("<h1>Hi, Guest!</h1>", self.client.get("/").text)
+
+    def test_cookieless_login(self):
+        """Logging in, or asking for a password reset, without session doesn't create a guest"""
+        from db.models.auth.account import Account
+        from db.models.auth.user import User
+
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        with self.app.app_context():
+            counts = (User.count(), Account.count())
+
+        client = self.app.test_client()
+        response = client.post("/login", data=dict(email="test@localhost", password="wrong"))
+        self.assertEqual(response.status_code, 401)
+        response = client.post("/forgotten_password", data=dict(email="nobody@localhost"))
+        self.assertEqual(response.status_code, 302)
+        response = client.post("/login", data=dict(email="test@localhost", password="test"))
+        self.assertEqual(response.status_code, 302)
+        with self.app.app_context():
+            self.assertEqual((User.count(), Account.count()), counts)
+        # The session opened by the login is kept by the cookie
+        response = client.get("/account")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("test@localhost", response.text)
+
+    def test_cookieless_post(self):
+        """The forms of the logged in users, posted without session (by bots...), redirect to the login page without
+        writing anything"""
+        import sqlite3
+
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        data_dir = self.app.config["DATA_DIR"]
+
+        def auth_db_rows():
+            with sqlite3.connect(data_dir / "auth.db") as con:
+                rows = {table: con.execute(f"SELECT * FROM {table}").fetchall() for table in ("user", "account")}
+            con.close()
+            return rows
+
+        rows, files = auth_db_rows(), set(data_dir.rglob("*"))
+        for url in ("/user/update", "/user/delete", "/account_create", "/account/1/delete", "/account/1/invite"):
+            response = self.app.test_client().post(url, data=dict(name="Bot", email="bot@localhost", role="user"))
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response.location, "/login")
+        self.assertEqual(auth_db_rows(), rows)
+        self.assertEqual(set(data_dir.rglob("*")), files)
+
+    def test_write_behind(self):
+        """Updates made with update_later are seen at once, but only written to the database when flushed"""
+        from db.connection import connect_to_db
+        from db.models.auth.user import User
+        from db.write_behind import WriteBehindBuffer
+
+        def name_in_database(user_id):
+            con = connect_to_db(User.db_file_name)
+            (name,) = con.execute("SELECT name FROM user WHERE id = ?", (user_id,)).fetchone()
+            con.close()
+            return name
+
+        buffer = WriteBehindBuffer(flush_interval=3600)
+        with self.app.app_context(), patch("db.write_behind.buffer", buffer):
+            user = User.get_by_id(User.insert(name="Before", email="write@localhost", password=None))
+            user.update_later(name="After")
+            self.assertEqual(User.get_by_id(user.id).name, "After")
+            self.assertEqual(name_in_database(user.id), "Before")
+            buffer.flush()
+            self.assertEqual(name_in_database(user.id), "After")
+        # The row cached before the update isn't read once the update is flushed
+        with self.app.app_context(), patch("db.write_behind.buffer", buffer):
+            self.assertEqual(User.get_by_id(user.id).name, "After")
+
+        # A synchronous update made during a flush is written after it
+        flush_started, write_allowed = threading.Event(), threading.Event()
+        write = buffer._write
+
+        def slow_write(*args):
+            flush_started.set()
+            write_allowed.wait(5)
+            return write(*args)
+
+        with self.app.app_context(), patch("db.write_behind.buffer", buffer), patch.object(buffer, "_write", slow_write):
+            User.get_by_id(user.id).update_later(name="Buffered")
+            flush_thread = threading.Thread(target=buffer.flush)
+            flush_thread.start()
+            flush_started.wait(5)
+            threading.Timer(0.1, write_allowed.set).start()
+            User.update_by_id(user.id, name="Synchronous")
+            flush_thread.join()
+            self.assertEqual(name_in_database(user.id), "Synchronous")
+
+    def test_reap_sessions(self):
+        """Only the sessions expired for longer than the grace period are deleted"""
+        from datetime import datetime, timedelta
+
+        from db.models.auth.session import Session
+        from db.models.auth.user import User
+        from maintenance import reap_sessions
+
+        with self.app.app_context():
+            user_id = User.insert(name="Reaped", email="reaped@localhost", password=None)
+            for days_ago in (30, 10, 1):
+                session_id = Session.insert(user_id=user_id)
+                Session.update_by_id(session_id, expires=datetime.now() - timedelta(days=days_ago))
+            Session.insert(user_id=user_id)  # Not expired
+
+            deleted_count, _ = reap_sessions(User.db_file_name, grace_period=timedelta(days=7), batch_size=1)
+            self.assertEqual(deleted_count, 2)
+            self.assertEqual(Session.count(user_id=user_id), 2)
+
+    def test_collect_guests(self):
+        """Only the old guests without session are deleted, with their account and database file"""
+        from datetime import timedelta
+
+        from db.models.auth.account import Account
+        from db.models.auth.session import Session
+        from db.models.auth.user import User
+        from maintenance import collect_guests
+
+        with self.app.app_context():
+            abandoned_guest_id = User.insert(name="Guest", email=None, password=None)
+            active_guest_id = User.insert(name="Guest", email=None, password=None)
+            Session.insert(user_id=active_guest_id)
+            user_id = User.insert(name="User", email="user@localhost", password=None)
+            for id in (abandoned_guest_id, active_guest_id, user_id):
+                User.update_by_id(id, created="2000-01-01 00:00:00")
+            abandoned_db_file_name = Path(User.get_by_id(abandoned_guest_id).current_account.account_db_file_name)
+
+            counts = collect_guests(User.db_file_name, self.app.config["DATA_DIR"], timedelta(days=1), dry_run=True)
+            self.assertEqual((counts["users"], counts["accounts"], counts["files"]), (1, 1, 1))
+            self.assertEqual(counts["bytes"], abandoned_db_file_name.stat().st_size)
+            self.assertEqual(User.count(), 3)
+
+            collect_guests(User.db_file_name, self.app.config["DATA_DIR"], timedelta(days=1), pause=0)
+            self.assertEqual([user.id for user in User.select()], [active_guest_id, user_id])
+            self.assertEqual(Account.count(), 2)
+            self.assertFalse(abandoned_db_file_name.exists())
+            self.assertFalse(abandoned_db_file_name.parent.exists())
+            # Their change counters are deleted with them
+            con = User.connect_to_db()
+            counters = {(scope, id) for scope, id in con.execute("SELECT scope, id FROM change_counter")}
+            self.assertEqual({scope for scope, id in counters}, {"user", "account"})
+            self.assertNotIn(("user", abandoned_guest_id), counters)
+            self.assertEqual(
+                counters,
+                {("user", user.id) for user in User.select()} | {("account", account.id) for account in Account.select()},
+            )
+
+    def test_query_plans(self):
+        """Run the integration test and make sure no query scans a whole table that is filtered on every request"""
+        import sqlite3
+
+        from db.models.auth.auth_model import AuthModel
+
+        with self._trace_statements() as statements:
+            self.test_integration()
+
+        con = sqlite3.connect(AuthModel.db_file_name)
+        for statement in set(statements):
+            if not statement.startswith(("SELECT", "UPDATE", "DELETE")) or "WHERE" not in statement:
+                continue  # Only look at the queries filtering rows: the other ones are expected to read everything
+            for *_, detail in con.execute(f"EXPLAIN QUERY PLAN {statement}"):
+                with self.subTest(statement=statement):
+                    self.assertNotRegex(detail, r"^SCAN (session|user_account|user|invitation)\b")
+        con.close()
+
+    def test_prefetch(self):
+        """The account page runs the same number of queries whatever the number of accounts, members and invitations"""
+
+        def account_page_statement_count():
+            with self._trace_statements() as statements:
+                response = self.client.get("/account")
+            self.assertEqual(response.status_code, 200)
+            return len(statements)
+
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        self.client.get("/account")  # Fill the session and user caches
+        statement_count = account_page_statement_count()
+
+        for i in range(3):
+            self.client.post("/account_create", data=dict(name=f"Company {i}"))
+            self.client.post(f"/account/{i + 2}/invite", data=dict(email=f"invitee{i}@localhost", role="user"))
+        response = self.client.get("/account")
+        self.assertIn(b"invitee2@localhost", response.data)
+        self.assertEqual(account_page_statement_count(), statement_count)
+
+    def test_identity_map(self):
+        """Within a request, each row is fetched once and represented by a single instance, kept up to date"""
+        from db import identity_map
+        from db.models.auth.account import Account
+        from db.models.auth.user import User
+
+        with self.app.app_context():
+            user_id = User.insert(name="Mapped", email="mapped@localhost", password=None)
+
+        with self.app.test_request_context():
+            user = User.get_by_id(user_id)
+            with patch("db.model.Model.connect_to_db") as connect_to_db:
+                self.assertIs(User.get_by_id(user_id), user)
+            connect_to_db.assert_not_called()
+            self.assertIs(User.select(email="mapped@localhost")[0], user)
+            self.assertEqual(identity_map.current().avoided_fetch_count, 1)
+
+            User.update_by_id(user_id, name="Renamed")
+            self.assertEqual(user.name, "Renamed")
+            account = user.current_account
+            self.assertIs(Account.get_by_id(account.id), account)
+            account.delete()
+            self.assertIsNone(Account.get_by_id(account.id))
+
+        with self.app.test_request_context():
+            self.assertIsNot(User.get_by_id(user_id), user)
+
+    def test_model_slots(self):
+        """Model instances have slots instead of a __dict__, are built from tuples and keep the pending updates"""
+        from db.models.auth.user import User
+        from db.write_behind import WriteBehindBuffer
+
+        buffer = WriteBehindBuffer(flush_interval=3600)
+        with self.app.app_context(), patch("db.write_behind.buffer", buffer):
+            user_id = User.insert(name="Slotted", email="slots@localhost", password=None)
+            user = User.get_by_id(user_id)
+            self.assertFalse(hasattr(user, "__dict__"))
+            with self.assertRaises(AttributeError):
+                user.nickname = "Slots"
+            self.assertIs(User.sql("select", ("email",)), User.sql("select", ("email",)))
+
+            user.update_later(name="Pending")
+            values = (user_id, "Slotted", "slots@localhost", None, None, None, user.current_account_id)
+        with self.app.app_context(), patch("db.write_behind.buffer", buffer):
+            self.assertEqual(User.from_values(values).name, "Pending")
+            buffer.flush()
+
+    def test_bulk_writes(self):
+        """insert_many, update_where and delete_where write all the rows at once and keep the instances up to date"""
+        from db.models.auth.invitation import Invitation
+        from db.models.auth.user import User
+
+        with self.app.app_context():
+            user = User.get_by_id(User.insert(name="Bulk", email="bulk@localhost", password=None))
+            rows = [
+                dict(email=f"bulk{i}@localhost", created_by=user.id, account_id=user.current_account_id, role="user")
+                for i in range(3)
+            ]
+            self.assertEqual(Invitation.insert_many(rows), 3)
+            invitations = Invitation.select(account_id=user.current_account_id)
+            self.assertEqual(len({invitation.secret for invitation in invitations}), 3)
+
+            updated_ids = [invitations[0].id, invitations[1].id]
+            self.assertEqual(Invitation.update_where({"id": updated_ids}, status="declined"), 2)
+            self.assertEqual([invitation.status for invitation in invitations], ["declined", "declined", "pending"])
+            self.assertEqual(User.update_where({"email": "bulk@localhost"}, name="Renamed"), 1)
+            self.assertEqual(user.name, "Renamed")
+
+            self.assertEqual(Invitation.delete_where(account_id=user.current_account_id, status="declined"), 2)
+            self.assertEqual(Invitation.count(account_id=user.current_account_id), 1)
+
+            # Without filters, they would rewrite or delete the whole table
+            with self.assertRaises(ValueError):
+                Invitation.update_where({}, status="declined")
+            with self.assertRaises(ValueError):
+                Invitation.delete_where()
+            self.assertEqual(Invitation.count(account_id=user.current_account_id), 1)
+
+        # Deleting the current account of the user assigns them another one
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        self.client.post("/account_create", data=dict(name="Company"))
+        with self.app.app_context():
+            (account_id,) = [account.id for account in User.select(email="test@localhost")[0].account_set][1:]
+        self.client.get(f"/?account_id={account_id}")
+        response = self.client.post(f"/account/{account_id}/delete", follow_redirects=True)
+        self.assertIn("Account deleted successfully!", response.text)
+        with self.app.app_context():
+            user = User.select(email="test@localhost")[0]
+            self.assertEqual([account.id for account in user.account_set], [user.current_account_id])
+
+    def test_stream(self):
+        """Streams read the rows by chunks, sorted and paginated by key, and only within a with statement"""
+        from db import identity_map
+        from db.models.auth.session import Session
+        from db.models.auth.user import User
+
+        with self.app.app_context():
+            user_id = User.insert(name="Streamed", email="stream@localhost", password=None)
+            session_ids = [Session.insert(user_id=user_id) for _ in range(5)]
+
+            with Session.stream(user_id=user_id, chunk_size=2) as sessions:
+                self.assertEqual([session.id for session in sessions], session_ids)
+            self.assertEqual(identity_map.current().instances.get((str(Session.db_file_name), "session")), {})
+
+            pages = []
+            last_id = None
+            while True:
+                with Session.stream(user_id=user_id, order_by="-id", after=last_id, limit=2) as sessions:
+                    page = [session.id for session in sessions]
+                if not page:
+                    break
+                pages.append(page)
+                last_id = page[-1]
+            self.assertEqual(pages, [session_ids[4:2:-1], session_ids[2:0:-1], session_ids[:1]])
+
+            with self.assertRaises(Exception):
+                list(Session.stream(user_id=user_id))
+
+    def test_transaction(self):
+        """The writes of a unit of work are committed at once at its end, or not at all"""
+        import db
+        from db.connection import connect_to_db
+        from db.models.auth.user import User
+
+        def committed_user_count():
+            con = connect_to_db(User.db_file_name)
+            (count,) = con.execute("SELECT COUNT(*) FROM user").fetchone()
+            con.close()
+            return count
+
+        with self.app.app_context():
+            with db.transaction():
+                User.insert(name="First", email="first@localhost", password=None)
+                with User.transaction():
+                    User.insert(name="Second", email="second@localhost", password=None)
+                self.assertEqual(User.count(), 2)
+                self.assertEqual(committed_user_count(), 0)
+            self.assertEqual(committed_user_count(), 2)
+
+            with self.assertRaises(ZeroDivisionError):
+                with db.transaction():
+                    User.insert(name="Third", email="third@localhost", password=None)
+                    1 / 0
+            self.assertEqual(committed_user_count(), 2)
+            self.assertEqual(User.select(email="third@localhost"), [])
+
+            # Rows read in a unit of work aren't cached, since they could still be rolled back
+            (user,) = User.select(email="first@localhost")
+        with self.app.app_context():
+            with self.assertRaises(ZeroDivisionError):
+                with db.transaction():
+                    User.update_by_id(user.id, name="Rolled back")
+                    User.get_by_id(user.id)
+                    1 / 0
+        with self.app.app_context():
+            self.assertEqual(User.get_by_id(user.id).name, "First")
+
+            # Rows cached by another thread during the unit of work are evicted at its end
+            with db.transaction():
+                User.update_by_id(user.id, name="Committed")
+                User.cache.set(user.id, tuple(getattr(user, field) for field in User.fields))  # Read before the commit
+        with self.app.app_context():
+            self.assertEqual(User.get_by_id(user.id).name, "Committed")
+
+    def test_email_outbox(self):
+        """Emails are only queued by the requests, and the failed deliveries are retried later, a few times"""
+        from blueprints.email import get_transport
+        from db.models.auth.outbox_email import OutboxEmail
+
+        self.app.config.update(EMAIL_MAX_ATTEMPTS=2, EMAIL_RETRY_DELAY=3600)
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        response = self.client.post("/account/1/invite", data=dict(email="invitee@localhost", role="user"))
+        self.assertEqual(response.status_code, 302)
+
+        with self.app.app_context():
+            (outbox_email,) = OutboxEmail.select()
+            self.assertEqual((outbox_email.status, outbox_email.attempts), ("pending", 0))
+        with patch.object(get_transport(self.app), "send", side_effect=OSError("Provider down")):
+            self.assertEqual(self._deliver_emails(), [])
+        with self.app.app_context():
+            outbox_email = OutboxEmail.get_by_id(outbox_email.id)
+            self.assertEqual((outbox_email.status, outbox_email.attempts), ("pending", 1))
+            self.assertEqual(outbox_email.last_error, "OSError: Provider down")
+
+        self.assertEqual(self._deliver_emails(), [])  # Not due yet
+        with self.app.app_context():
+            OutboxEmail.update_by_id(outbox_email.id, next_attempt=outbox_email.created)
+        (delivered_email,) = self._deliver_emails()
+        self.assertIn("Subject: [Your App] You have been invited", delivered_email)
+        with self.app.app_context():
+            outbox_email = OutboxEmail.get_by_id(outbox_email.id)
+            self.assertEqual((outbox_email.status, outbox_email.attempts, outbox_email.last_error), ("sent", 2, None))
+
+            # Giving up after EMAIL_MAX_ATTEMPTS
+            failing_email = OutboxEmail.get_by_id(OutboxEmail.insert(to_email="x@localhost", subject="", html_content=""))
+        self.app.config["EMAIL_RETRY_DELAY"] = 0
+        with patch.object(get_transport(self.app), "send", side_effect=OSError("Provider down")):
+            self._deliver_emails()
+        with self.app.app_context():
+            self.assertEqual(OutboxEmail.get_by_id(failing_email.id).status, "failed")
+
+    def test_email_worker_startup(self):
+        """The emails left due by the previous processes are delivered when the app starts, and purged later"""
+        from datetime import timedelta
+
+        from app import create_app
+        from blueprints.email import OutboxWorker
+        from db.models.auth.outbox_email import OutboxEmail, utc_timestamp
+        from maintenance import purge_emails
+
+        with self.app.app_context():
+            OutboxEmail.insert(to_email="due@localhost", subject="Due", html_content="")
+            db_file_name = OutboxEmail.db_file_name
+        worker = OutboxWorker()
+        with patch("blueprints.email.outbox_worker", worker):
+            config = dict(self.app.config, EMAIL_WORKER=True, EMAIL_POLL_INTERVAL=3600)
+            flask_app = create_app(config)
+            for _ in range(100):
+                if worker.sent_count:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(worker.sent_count, 1)
+
+        # In the processes forked after create_app() (gunicorn --preload), the thread is started again by wake()
+        thread = worker._thread
+        with self.app.app_context():
+            OutboxEmail.insert(to_email="forked@localhost", subject="Forked", html_content="")
+        with patch("blueprints.email.os.getpid", return_value=-1):
+            worker.wake(flask_app)
+        self.assertIsNot(worker._thread, thread)
+        for _ in range(100):
+            if worker.sent_count == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(worker.sent_count, 2)
+
+        with self.app.app_context():
+            old_email_id = OutboxEmail.insert(to_email="old@localhost", subject="Old", html_content="")
+            OutboxEmail.update_by_id(old_email_id, status="sent", sent=utc_timestamp(-8 * 24 * 3600))
+            OutboxEmail.insert(to_email="pending@localhost", subject="Pending", html_content="")
+        deleted_count, _ = purge_emails(db_file_name, older_than=timedelta(days=7), batch_size=1)
+        self.assertEqual(deleted_count, 1)
+        with self.app.app_context():
+            self.assertEqual(
+                sorted(email.to_email for email in OutboxEmail.select()),
+                ["due@localhost", "forked@localhost", "pending@localhost"],
+            )
+
+    def test_invite_many(self):
+        """Many users are invited with one request, in one transaction, with a result for each email"""
+        from db.models.auth.invitation import Invitation
+
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        self.client.post("/account/1/invite", data=dict(email="first@localhost", role="user"))
+        self._deliver_emails()
+
+        response = self.client.post(
+            "/account/1/invite_many",
+            json=dict(emails=["first@localhost", "second@localhost", "nope", "third@localhost", "second@localhost"],
+                      role="read-only"),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["results"], [
+            dict(email="first@localhost", result="already invited"),
+            dict(email="second@localhost", result="invited"),
+            dict(email="nope", result="invalid"),
+            dict(email="third@localhost", result="invited"),
+        ])
+        delivered_emails = self._deliver_emails()
+        self.assertEqual(len(delivered_emails), 2)
+        with self.app.app_context():
+            for email in ("second@localhost", "third@localhost"):
+                (invitation,) = Invitation.select(account_id=1, email=email)
+                self.assertEqual(invitation.role, "read-only")
+                self.assertTrue(any(f"To: {email}" in delivered and invitation.secret in delivered
+                                    for delivered in delivered_emails))
+
+        # From the form of the account page
+        response = self.client.post(
+            "/account/1/invite_many", data=dict(emails="fourth@localhost,\r\nthird@localhost", role="user")
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(self._deliver_emails()), 1)
+        response = self.client.get("/account")
+        self.assertIn("1 invitation(s) sent!", response.text)
+        self.assertIn("third@localhost: already invited", response.text)
+
+        response = self.client.post("/account/2/invite_many", json=dict(emails=["fifth@localhost"], role="user"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_password_hashing(self):
+        """Passwords are hashed by worker processes, and outdated hashes are upgraded at login"""
+        from passwords import PasswordHasherBusy, hasher
+        from db.models.auth.user import User
+
+        old_method, new_method = "scrypt:1024:8:1", self.app.config["PASSWORD_HASH_METHOD"]
+        hasher.configure(old_method, workers=1, max_queue=0)
+        try:
+            self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+            with self.app.app_context():
+                old_hash = User.select_one(email="test@localhost").password_hash
+            self.assertTrue(old_hash.startswith(old_method + "$"))
+
+            # No worker process available, nor queue
+            with hasher._slots:
+                with self.assertRaises(PasswordHasherBusy):
+                    hasher.generate("test")
+                response = self.client.post("/login", data=dict(email="test@localhost", password="test"))
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers["Retry-After"], "1")
+
+            hasher.configure(new_method, workers=1, max_queue=0)
+            self.client.get("/logout")
+            response = self.client.post("/login", data=dict(email="test@localhost", password="wrong"))
+            self.assertEqual(response.status_code, 401)
+            with self.app.app_context():
+                self.assertEqual(User.select_one(email="test@localhost").password_hash, old_hash)
+            response = self.client.post("/login", data=dict(email="test@localhost", password="test"))
+            self.assertEqual(response.status_code, 302)
+            with self.app.app_context():
+                new_hash = User.select_one(email="test@localhost").password_hash
+            self.assertTrue(new_hash.startswith(new_method + "$"))
+            self.assertTrue(hasher.check(new_hash, "test"))
+
+            # A worker process killed (by the OOM killer...) is replaced
+            for pid in list(hasher._executor._processes):
+                os.kill(pid, signal.SIGKILL)
+            self.assertTrue(hasher.check(new_hash, "test"))
+            self.assertEqual(hasher.broken_count, 1)
+
+            # Methods without parameters use werkzeug's defaults, and don't upgrade the hashes made with them
+            hasher.configure("scrypt", workers=0, max_queue=0)
+            self.assertEqual(hasher.method, "scrypt:32768:8:1")
+            self.assertFalse(hasher.needs_rehash(new_hash))
+            self.client.get("/logout")
+            self.client.post("/login", data=dict(email="test@localhost", password="test"))
+            with self.app.app_context():
+                self.assertEqual(User.select_one(email="test@localhost").password_hash, new_hash)
+        finally:
+            hasher.configure(new_method, workers=0, max_queue=0)
+
+    def test_rate_limit(self):
+        """The auth endpoints are limited per IP and per email, before hashing passwords or reading the database"""
+        from ratelimit import SQLiteBuckets, limiter
+
+        config = self.app.config
+        limiter.configure("memory", None, {"ip": (4, 60), "email": (2, 60)})
+        for _ in range(2):
+            response = self.client.post("/login", data=dict(email="Test@localhost", password="wrong"))
+            self.assertEqual(response.status_code, 401)
+        with patch("db.models.auth.user.User.login") as login:
+            response = self.client.post("/login", data=dict(email="test@localhost ", password="wrong"))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers["Retry-After"], "30")
+            response = self.client.post("/forgotten_password", data=dict(email="other@localhost"))
+            self.assertEqual(response.status_code, 302)
+            response = self.client.post("/signup", data=dict(email="another@localhost"))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers["Retry-After"], "15")
+            login.assert_not_called()
+        self.assertEqual(self.client.get("/login").status_code, 200)
+        self.assertEqual(limiter.stats(), {"ip": {"allowed": 4, "limited": 1}, "email": {"allowed": 3, "limited": 1}})
+
+        # Shared by the processes
+        db_file_name = config["DATA_DIR"] / "rate_limits.db"
+        limiter.configure("sqlite", db_file_name, {"ip": (1, 60)})
+        self.assertEqual(self.client.post("/reset_password", data=dict(secret="nope")).status_code, 302)
+        self.assertEqual(self.client.post("/reset_password", data=dict(secret="nope")).status_code, 429)
+        self.assertEqual(SQLiteBuckets(db_file_name).stats(), {"ip": {"allowed": 1, "limited": 1}})
+
+    def test_static_assets(self):
+        """Static files are linked by the hash of their content, cached forever, and served compressed"""
+        import gzip
+        import re
+
+        response = self.client.get("/")
+        (css_url,) = re.findall(r'href="(/assets/css/style\.[0-9a-f]{12}\.css)"', response.text)
+        self.assertRegex(response.text, r'src="/assets/img/logo\.[0-9a-f]{12}\.png"')
+        content = (Path(self.app.static_folder) / "css" / "style.css").read_bytes()
+
+        response = self.client.get(css_url, headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("Set-Cookie", response.headers)
+        self.assertEqual(gzip.decompress(response.data), content)
+        response = self.client.get(css_url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 200)  # Not the same variant
+        response = self.client.get(css_url)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data, content)
+        response = self.client.get(css_url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.client.get("/assets/css/style.000000000000.css").status_code, 404)
+        self.assertEqual(self.client.get("/static/css/style.css").status_code, 200)
+
+    def test_static_assets_brotli(self):
+        """With a brotli module, the text files are also served compressed with brotli, preferred to gzip"""
+        import re
+
+        from blueprints.assets import brotli
+
+        if brotli is None:
+            self.skipTest("Neither brotli nor brotlicffi is installed")
+        (css_url,) = re.findall(r'href="(/assets/css/style\.[0-9a-f]{12}\.css)"', self.client.get("/").text)
+        response = self.client.get(css_url, headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        content = (Path(self.app.static_folder) / "css" / "style.css").read_bytes()
+        self.assertEqual(brotli.decompress(response.data), content)
+
+    def test_conditional_get(self):
+        """The account page is answered 304 without building it, until something it displays changes"""
+        from db.models.auth.user import User
+        from db.models.auth.user_account import UserAccount
+
+        self.client.post("/signup", data=dict(name="Test", email="test@localhost", password="test", password2="test"))
+        self.client.get("/")  # Displays the flashed messages
+
+        def get_account_page(etag):
+            return self.client.get("/account", headers={"If-None-Match": etag} if etag else {})
+
+        etag = get_account_page(None).headers["ETag"]
+        with patch("db.models.auth.account.Account.prefetch") as prefetch:
+            response = get_account_page(etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers["ETag"], etag)
+            prefetch.assert_not_called()
+        self.assertEqual(self.client.get("/account?tab=user-tab-pane", headers={"If-None-Match": etag}).status_code, 200)
+
+        # Changes made by the user, then the flashed message is displayed once, then the page is cached again
+        self.client.post("/account/1/update", data=dict(name="Renamed"))
+        response = get_account_page(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Account updated successfully!", response.text)
+        self.assertNotIn("ETag", response.headers)
+        response = get_account_page(etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertEqual(get_account_page(etag).status_code, 304)
+
+        # Changes made by another user of the account, and the database triggers on the invitations
+        with self.app.app_context():
+            other_user_id = User.insert(name="Other", email="other@localhost", password=None)
+            UserAccount.insert(user_id=other_user_id, account_id=1, role="user")
+        response = get_account_page(etag)
+        self.assertIn("Other", response.text)
+        etag = response.headers["ETag"]
+        with self.app.app_context():
+            User.update_by_id(other_user_id, name="Renamed other")
+        response = get_account_page(etag)
+        self.assertIn("Renamed other", response.text)
+        etag = response.headers["ETag"]
+        with self.app.app_context():
+            User.update_by_id(other_user_id, last_login="2000-01-01")  # Not displayed
+        self.assertEqual(get_account_page(etag).status_code, 304)
+        self.client.post("/account/1/invite_many", data=dict(emails="invitee@localhost", role="user"))
+        self.client.get("/")
+        self.assertEqual(get_account_page(etag).status_code, 200)
+
+    def test_migration_checksum(self):
+        """Migrations edited after being applied are detected"""
+        import migrate
+
+        db_file_name = self.app.config["DATA_DIR"] / "checksum.db"
+        migration = migrate.Migration(1, "00001_init.sql", "CREATE TABLE book (id INTEGER PRIMARY KEY);", "checksum")
+        migrate.migrate(db_file_name, [migration])
+        # Applying the same migration again is a no-op
+        migrate.migrate(db_file_name, [migration])
+        with self.assertRaises(Exception):
+            migrate.migrate(db_file_name, [migration._replace(checksum="edited")])
+
+    def test_template_db(self):
+        """Only the templates built before the current one are deleted, and no temporary file is left behind"""
+        import migrate
+
+        data_dir = self.app.config["DATA_DIR"]
+        template_db_file_name = migrate.build_template_db("accounts", data_dir)
+        older, newer = data_dir / "templates" / "accounts_older.db", data_dir / "templates" / "accounts_newer.db"
+        older.touch()
+        newer.touch()
+        built = template_db_file_name.stat().st_mtime
+        os.utime(older, (built - 60, built - 60))
+        os.utime(newer, (built + 60, built + 60))
+        migrate.delete_outdated_templates("accounts", data_dir)
+        self.assertEqual(sorted((data_dir / "templates").iterdir()), sorted([template_db_file_name, newer]))
+
+    def test_migrate_accounts(self):
+        """A broken account database doesn't prevent the other ones from being migrated, and the accounts migrated are
+        skipped by the next runs"""
+        import sqlite3
+
+        import migrate
+        from db.models.auth.account import Account
+
+        for name in ("first", "second", "third"):
+            client = self.app.test_client()
+            client.post("/signup", data=dict(name=name, email=f"{name}@localhost", password="test", password2="test"))
+        # The accounts don't have migrations yet: add one
+        code = "CREATE TABLE note (id INTEGER PRIMARY KEY);"
+        migration = migrate.Migration(1, "00001_note.sql", code, hashlib.sha256(code.encode()).hexdigest())
+        with self.app.app_context(), patch.dict(migrate._migrations_registry, {"accounts": (migration,)}):
+            accounts = {account.id: account.account_db_file_name for account in Account.select()}
+            self.assertEqual(len(accounts), 3)
+            broken_id = min(accounts)
+            Path(accounts[broken_id]).write_bytes(b"not a database" * 100)
+
+            failures = migrate.run(jobs=2)
+            self.assertEqual(list(failures), [broken_id])
+            self.assertIn("DatabaseError", failures[broken_id])
+            latest_version = migrate.schema_version(migrate.get_migrations("accounts"))
+            with sqlite3.connect(Account.db_file_name) as con:  # Written by run(), without the Account model
+                schema_versions = dict(con.execute("SELECT id, schema_version FROM account"))
+            con.close()
+            self.assertEqual(schema_versions, {id: 0 if id == broken_id else latest_version for id in accounts})
+
+            # Once repaired, the broken account is the only one migrated again
+            Path(accounts[broken_id]).unlink()
+            with patch("migrate.migrate", wraps=migrate.migrate) as migrate_db:
+                self.assertEqual(migrate.run(), {})
+            self.assertEqual([call.args[0] for call in migrate_db.call_args_list][1:], [accounts[broken_id]])
+
+            # Then no account database is opened at all
+            with patch("migrate.migrate", wraps=migrate.migrate) as migrate_db:
+                self.assertEqual(migrate.run(), {})
+            self.assertEqual(len(migrate_db.call_args_list), 1)  # Only the auth database
+
     def _test_guest_access(self):
         """Test guest access"""
         from db.models.auth.account import Account
@@ -101,8 +914,10 @@ class TestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         response = self.client.get("/signup")
         self.assertEqual(response.status_code, 200)
-        self.guest_user = User.select(name="Guest")[0]
-        self.guest_account = Account.select(name="Personal")[0]
+        # Browsing as a guest doesn't create anything in the database until something needs to be saved
+        self.assertEqual(User.count(), 0)
+        self.assertEqual(Account.count(), 0)
+        self.assertFalse((self.app.config["DATA_DIR"] / "accounts").exists())
 
     def _test_signup(self):
         """Test the signup process"""
@@ -252,16 +1067,16 @@ class TestCase(unittest.TestCase):
         """Test the invite user process"""
         from db.models.auth.invitation import Invitation
 
-        with patch("blueprints.email.SendGridAPIClient") as mock_send_email:
-            response = self.client.post(
-                f"/account/{self.company_a.id}/invite",
-                data=dict(
-                    email="invitee@localhost",
-                    role="user",
-                ),
-                follow_redirects=False,
-            )
-        mock_send_email.assert_called_once()
+        response = self.client.post(
+            f"/account/{self.company_a.id}/invite",
+            data=dict(
+                email="invitee@localhost",
+                role="user",
+            ),
+            follow_redirects=False,
+        )
+        (delivered_email,) = self._deliver_emails()
+        self.assertIn("To: invitee@localhost", delivered_email)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.location, "/account")
         # Follow the redirect manually
@@ -392,15 +1207,15 @@ class TestCase(unittest.TestCase):
         for session in Session.select():
             max_session_id = max(max_session_id, session.id)
 
-        with patch("blueprints.email.SendGridAPIClient") as mock_send_email:
-            response = self.client.post(
-                "/forgotten_password",
-                data=dict(
-                    email="invitee@localhost",
-                ),
-                follow_redirects=False,
-            )
-        mock_send_email.assert_called_once()
+        response = self.client.post(
+            "/forgotten_password",
+            data=dict(
+                email="invitee@localhost",
+            ),
+            follow_redirects=False,
+        )
+        (delivered_email,) = self._deliver_emails()
+        self.assertIn("To: invitee@localhost", delivered_email)
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.location, "/login")
         # Follow the redirect manually